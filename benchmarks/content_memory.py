@@ -0,0 +1,53 @@
+"""
+Memory of media records of one user, with and w/o raw API dicts (--debug).
+
+    python -m benchmarks.content_memory -n 100000
+"""
+import argparse
+import json
+import tracemalloc
+
+from benchmarks.fixtures import make_media
+from vsco_downloader.container import VscoContent
+from vsco_downloader.user import VscoUser
+
+PAGE_SIZE = 100
+
+
+def make_api_pages(count):
+    """Serialized pages, so every record is parsed like an API answer"""
+    return [
+        json.dumps({
+            'media': [{
+                'type': 'image',
+                'image': make_media(1000, index)
+            } for index in range(start, min(start + PAGE_SIZE, count))]
+        }) for start in range(0, count, PAGE_SIZE)
+    ]
+
+
+def measure(pages, keep_raw):
+    VscoContent.keep_raw = keep_raw
+    tracemalloc.start()
+    user = VscoUser('user', None)
+    for page in pages:
+        for media in json.loads(page)['media']:
+            user.add_content(media[media['type']])
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retained, len(user.all_content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory of media records')
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    args = parser.parse_args()
+    pages = make_api_pages(args.count)
+    for name, keep_raw in (('raw dicts', True), ('records', False)):
+        retained, count = measure(pages, keep_raw)
+        print(f'{name:>9}: {retained / 1024 / 1024:7.1f} MiB '
+              f'for {count} items, {retained / count:6.0f} B / item')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Gallery pages like vsco.co ones for benchmarks.
+Real pages can be saved to the same dir (``<username>.html``) instead.
+
+    python -m benchmarks.fixtures -d benchmarks/fixtures -n 50
+"""
+import argparse
+import json
+import os
+import random
+
+JUNK_SIZE = 300
+
+
+def make_media(user_id, index):
+    media_id = f'{user_id:x}{index:08x}'
+    is_video = index % 10 == 0
+    media = {
+        'id': media_id,
+        'siteId': user_id,
+        'captureDate': 1600000000000 + index * 60000,
+        'uploadDate': 1600000000000 + index * 60000,
+        'isVideo': is_video,
+        'responsiveUrl': f'im.vsco.co/aws-us-west-2/{media_id}.jpg',
+        'imageMeta': {
+            'aperture': 2.8,
+            'make': 'Apple',
+            'model': 'iPhone',
+            'width': 4032,
+            'height': 3024
+        },
+        'description': 'x' * random.randint(0, 200),
+        'permalink': f'https://vsco.co/user{user_id}/media/{media_id}',
+        'perma_subdomain': f'user{user_id}',
+        'gridName': f'user{user_id}',
+        'imageStatus': {
+            'code': 1,
+            'time': 1600000000000
+        },
+        'showLocation': 1,
+        'hasLocation': False,
+        'isFeatured': False,
+        'presetName': 'A6',
+        'presetShortName': 'A6',
+        'width': 4032,
+        'height': 3024,
+    }
+    if is_video:
+        media['videoUrl'] = f'img.vsco.co/{media_id}/playlist.m3u8'
+    return media
+
+
+def make_state(user_name, user_id, media_count=14, junk_count=JUNK_SIZE):
+    images = {
+        media['id']: media
+        for media in (make_media(user_id, index)
+                      for index in range(media_count))
+    }
+    return {
+        'sites': {
+            'siteByUsername': {
+                user_name: {
+                    'site': {
+                        'id': user_id,
+                        'name': user_name
+                    }
+                }
+            }
+        },
+        'entities': {
+            'images': images,
+            'articles': {},
+            'collections': {}
+        },
+        'medias': {
+            'bySiteId': {
+                str(user_id): {
+                    'nextCursor': 'Y3Vyc29y',
+                    'medias': list(images)
+                }
+            }
+        },
+        'users': {
+            'currentUser': {
+                'tkn': 'f' * 32
+            }
+        },
+        # the rest of the real state: i18n, feeds, journal etc.
+        'i18n': {f'key_{index}': 'text ' * 10
+                 for index in range(junk_count)},
+        'journal': [{
+            'id': index,
+            'blocks': [{
+                'type': 'text',
+                'text': 'y' * 100
+            }] * 5
+        } for index in range(junk_count)],
+    }
+
+
+def make_page(user_name, user_id, media_count=14, junk_count=JUNK_SIZE):
+    state = json.dumps(make_state(user_name, user_id, media_count,
+                                  junk_count))
+    scripts = ''.join(f'<script src="/static/js/{index}.js"></script>'
+                      for index in range(20))
+    return (f'<!DOCTYPE html><html><head>{scripts}</head><body>'
+            f'<div id="root">{"<div>" * 200}{"</div>" * 200}</div>'
+            f'<script>window.__PRELOADED_STATE__ = {state}</script>\n'
+            f'<script>window.__SSR__ = true</script>'
+            f'{scripts}</body></html>')
+
+
+def save_fixtures(fixture_dir, count, media_count=14, junk_count=JUNK_SIZE):
+    os.makedirs(fixture_dir, exist_ok=True)
+    for index in range(count):
+        user_name = f'user{index}'
+        with open(os.path.join(fixture_dir, f'{user_name}.html'),
+                  'w') as page_file:
+            page_file.write(
+                make_page(user_name, 1000 + index, media_count, junk_count))
+
+
+def load_fixtures(fixture_dir):
+    """:return: {username: html}"""
+    pages = {}
+    for file_name in sorted(os.listdir(fixture_dir)):
+        user_name, extension = os.path.splitext(file_name)
+        if extension != '.html':
+            continue
+        with open(os.path.join(fixture_dir, file_name)) as page_file:
+            pages[user_name] = page_file.read()
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Save gallery pages')
+    parser.add_argument('-d', '--fixture-dir', default='benchmarks/fixtures')
+    parser.add_argument('-n', '--count', type=int, default=50)
+    parser.add_argument('-m', '--media-count', type=int, default=14)
+    parser.add_argument('-j', '--junk-count', type=int, default=JUNK_SIZE)
+    args = parser.parse_args()
+    random.seed(0)
+    save_fixtures(args.fixture_dir, args.count, args.media_count,
+                  args.junk_count)
+
+
+if __name__ == '__main__':
+    main()
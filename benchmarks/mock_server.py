@@ -0,0 +1,330 @@
+"""
+Local server like vsco.co and its content servers for benchmarks:
+gallery pages with the preloaded state, the paginated media API,
+images/mini-videos of a fixed size, m3u8 playlists and TS segments.
+Latency, bandwidth and error/429 rates are set by options.
+
+    python -m benchmarks.mock_server --users 10 --photos 500 --latency 0.05
+
+Requests are counted by kind, the counters are served at ``/_stats``.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import zlib
+from collections import Counter
+
+from aiohttp import web
+
+from benchmarks.fixtures import make_state
+
+USER_PREFIX = 'user'
+FIRST_SITE_ID = 1000
+FIRST_PAGE_SIZE = 14
+TOKEN = 'f' * 32
+CAPTURE_DATE = 1600000000000
+BLOCK_SIZE = 64 * 1024
+WRITE_CHUNK_SIZE = 16 * 1024
+
+
+class MockVsco:
+    def __init__(self,
+                 *,
+                 users=1,
+                 photos=100,
+                 mini_videos=0,
+                 videos=0,
+                 photo_size=200 * 1024,
+                 mini_video_size=1024 * 1024,
+                 segments=10,
+                 segment_size=100 * 1024,
+                 max_page_size=100,
+                 latency=0.0,
+                 bandwidth=0,
+                 error_rate=0.0,
+                 throttle_rate=0.0,
+                 cdn_host=None):
+        """
+        :param bandwidth: bytes per second of one response, 0 is unlimited
+        :param error_rate: share of API/content requests answered by 503
+        :param throttle_rate: share of API/content requests answered by 429
+        :param cdn_host: host of content urls, the request host by default
+        """
+        self.users = users
+        self.photos = photos
+        self.mini_videos = mini_videos
+        self.videos = videos
+        self.photo_size = photo_size
+        self.mini_video_size = mini_video_size
+        self.segments = segments
+        self.segment_size = segment_size
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.cdn_host = cdn_host
+        self.stats = Counter()
+        self._block = os.urandom(BLOCK_SIZE)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/_stats', self._get_stats)
+        app.router.add_get('/api/3.0/medias/profile', self._get_medias)
+        app.router.add_get('/img/{user_name}/{name}', self._get_image)
+        app.router.add_get('/vid/{media_id}/master.m3u8', self._get_master)
+        app.router.add_get('/vid/{media_id}/{resolution}.m3u8',
+                           self._get_playlist)
+        app.router.add_get('/seg/{media_id}/{name}', self._get_segment)
+        app.router.add_get('/{user_name}/gallery', self._get_gallery)
+        return app
+
+    def get_media(self, user_name, cdn_host):
+        """
+        All media of a user in the API format, newest first.
+        Types are interleaved like posts of a real gallery.
+        """
+        media = []
+        for index in range(self.photos):
+            media.append(((index + 0.5) / self.photos, {
+                'type': 'image',
+                'image': {
+                    '_id': f'{user_name}p{index}',
+                    'responsive_url': f'{cdn_host}/img/{user_name}/'
+                    f'p{index}.jpg',
+                    'file_size': self.photo_size,
+                }
+            }))
+        for index in range(self.mini_videos):
+            media.append(((index + 0.5) / self.mini_videos, {
+                'type': 'image',
+                'image': {
+                    '_id': f'{user_name}m{index}',
+                    'responsive_url': f'{cdn_host}/img/{user_name}/'
+                    f'm{index}.jpg',
+                    'video_url': f'{cdn_host}/img/{user_name}/m{index}.mp4',
+                    'file_size': self.mini_video_size,
+                }
+            }))
+        for index in range(self.videos):
+            media_id = f'{user_name}v{index}'
+            media.append(((index + 0.5) / self.videos, {
+                'type': 'video',
+                'video': {
+                    '_id': media_id,
+                    'playback_url': f'http://{cdn_host}/vid/{media_id}/'
+                    f'master.m3u8',
+                }
+            }))
+        media = [item for _, item in sorted(media, key=lambda pair: pair[0])]
+        for index, item in enumerate(media):
+            date_key = ('created_date'
+                        if item['type'] == 'video' else 'capture_date')
+            item[item['type']][date_key] = CAPTURE_DATE - index * 1000
+        return media
+
+    def get_blob(self, path, size):
+        """Distinct content of ``size`` bytes for every path"""
+        header = path.encode()
+        blocks = self._block * (size // BLOCK_SIZE + 1)
+        return (header + blocks)[:size]
+
+    def _get_site_id(self, user_name):
+        index = user_name[len(USER_PREFIX):]
+        if (not user_name.startswith(USER_PREFIX) or not index.isdigit()
+                or int(index) >= self.users):
+            raise web.HTTPNotFound()
+        return FIRST_SITE_ID + int(index)
+
+    def _get_cdn_host(self, request):
+        return self.cdn_host or request.host
+
+    async def _delay(self, kind):
+        """Count a request, wait for the latency and maybe fail it"""
+        self.stats[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chance = random.random()
+        if chance < self.throttle_rate:
+            self.stats['throttled'] += 1
+            raise web.HTTPTooManyRequests(headers={'Retry-After': '0'})
+        if chance < self.throttle_rate + self.error_rate:
+            self.stats['errors'] += 1
+            raise web.HTTPServiceUnavailable()
+
+    async def _send(self, request, body, content_type):
+        """Send a body with Range, If-Range and the bandwidth limit"""
+        etag = f'"{zlib.crc32(body):08x}"'
+        headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+        status = 200
+        range_header = request.headers.get('Range')
+        if_range = request.headers.get('If-Range')
+        if range_header and (if_range is None or if_range == etag):
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(body):
+                raise web.HTTPRequestRangeNotSatisfiable(
+                    headers={'Content-Range': f'bytes */{len(body)}'})
+            headers['Content-Range'] = (f'bytes {start}-{len(body) - 1}/'
+                                        f'{len(body)}')
+            body = body[start:]
+            status = 206
+        self.stats['bytes'] += len(body)
+        if not self.bandwidth:
+            return web.Response(body=body,
+                                status=status,
+                                headers=headers,
+                                content_type=content_type)
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_type = content_type
+        response.content_length = len(body)
+        await response.prepare(request)
+        for start in range(0, len(body), WRITE_CHUNK_SIZE):
+            chunk = body[start:start + WRITE_CHUNK_SIZE]
+            await response.write(chunk)
+            await asyncio.sleep(len(chunk) / self.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def _get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def _get_gallery(self, request):
+        user_name = request.match_info['user_name']
+        site_id = self._get_site_id(user_name)
+        await self._delay('gallery')
+        media = self.get_media(user_name, self._get_cdn_host(request))
+        # the page has the first window of media (of all types),
+        # the cursor of the API is the index in the whole list
+        state = make_state(user_name, site_id, media_count=0)
+        state['entities']['images'] = {
+            entity['id']: entity
+            for entity in map(self._get_entity, media[:FIRST_PAGE_SIZE])
+        }
+        state['medias']['bySiteId'][str(site_id)]['nextCursor'] = (
+            str(FIRST_PAGE_SIZE) if len(media) > FIRST_PAGE_SIZE else None)
+        state['users']['currentUser']['tkn'] = TOKEN
+        page = (f'<html><head></head><body><script>'
+                f'window.__PRELOADED_STATE__ = {json.dumps(state)}'
+                f'</script></body></html>')
+        return await self._send(request, page.encode(), 'text/html')
+
+    @staticmethod
+    def _get_entity(item):
+        """A media of the API in the format of the page state"""
+        if item['type'] == 'video':
+            video = item['video']
+            return {
+                'id': video['_id'],
+                'playback_url': video['playback_url'],
+                'captureDate': video['created_date'],
+            }
+        image = item['image']
+        entity = {
+            'id': image['_id'],
+            'responsiveUrl': image['responsive_url'],
+            'captureDate': image['capture_date'],
+        }
+        if 'video_url' in image:
+            entity['videoUrl'] = image['video_url']
+        return entity
+
+    async def _get_medias(self, request):
+        site_id = int(request.query['site_id'])
+        await self._delay('api')
+        if request.headers.get('Authorization') != f'Bearer {TOKEN}':
+            raise web.HTTPUnauthorized()
+        limit = int(request.query['limit'])
+        if limit > self.max_page_size:
+            raise web.HTTPBadRequest()
+        cursor = int(request.query.get('cursor') or 0)
+        user_name = f'{USER_PREFIX}{site_id - FIRST_SITE_ID}'
+        self._get_site_id(user_name)
+        media = self.get_media(user_name, self._get_cdn_host(request))
+        next_cursor = cursor + limit
+        page = {
+            'media': media[cursor:next_cursor],
+            'next_cursor':
+            str(next_cursor) if next_cursor < len(media) else None,
+        }
+        return await self._send(request,
+                                json.dumps(page).encode(), 'application/json')
+
+    async def _get_image(self, request):
+        await self._delay('content')
+        size = (self.mini_video_size if request.path.endswith('.mp4') else
+                self.photo_size)
+        return await self._send(request, self.get_blob(request.path, size),
+                                'application/octet-stream')
+
+    async def _get_master(self, request):
+        await self._delay('playlist')
+        host = self._get_cdn_host(request)
+        media_id = request.match_info['media_id']
+        playlist = ''.join(
+            f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},'
+            f'RESOLUTION={resolution}\n'
+            f'http://{host}/vid/{media_id}/{resolution}.m3u8\n'
+            for bandwidth, resolution in ((800000, '640x360'),
+                                          (2400000, '1280x720')))
+        return await self._send(request, f'#EXTM3U\n{playlist}'.encode(),
+                                'application/vnd.apple.mpegurl')
+
+    async def _get_playlist(self, request):
+        await self._delay('playlist')
+        host = self._get_cdn_host(request)
+        media_id = request.match_info['media_id']
+        segments = ''.join(f'#EXTINF:4.0,\n'
+                           f'http://{host}/seg/{media_id}/{index}.ts\n'
+                           for index in range(self.segments))
+        playlist = (f'#EXTM3U\n#EXT-X-TARGETDURATION:4\n{segments}'
+                    f'#EXT-X-ENDLIST\n')
+        return await self._send(request, playlist.encode(),
+                                'application/vnd.apple.mpegurl')
+
+    async def _get_segment(self, request):
+        await self._delay('segment')
+        return await self._send(request,
+                                self.get_blob(request.path,
+                                              self.segment_size), 'video/mp2t')
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--photos', type=int, default=100)
+    parser.add_argument('--mini-videos', type=int, default=0)
+    parser.add_argument('--videos', type=int, default=0)
+    parser.add_argument('--photo-size', type=int, default=200 * 1024)
+    parser.add_argument('--mini-video-size', type=int, default=1024 * 1024)
+    parser.add_argument('--segments', type=int, default=10)
+    parser.add_argument('--segment-size', type=int, default=100 * 1024)
+    parser.add_argument('--max-page-size', type=int, default=100)
+    add_network_arguments(parser)
+
+
+def add_network_arguments(parser):
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='seconds before every answer')
+    parser.add_argument('--bandwidth',
+                        type=int,
+                        default=0,
+                        help='bytes per second of one response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock of vsco.co')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    host, port = args.pop('host'), args.pop('port')
+    web.run_app(MockVsco(**args).make_app(), host=host, port=port)
+
+
+if __name__ == '__main__':
+    main()
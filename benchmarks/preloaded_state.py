@@ -0,0 +1,89 @@
+"""
+Microbenchmark of the first page parsing on generated pages
+or on saved fixture pages.
+
+    python -m benchmarks.preloaded_state -n 50
+    python -m benchmarks.fixtures -d benchmarks/fixtures
+    python -m benchmarks.preloaded_state -d benchmarks/fixtures
+"""
+import argparse
+import json
+import os
+import random
+import re
+import time
+import tracemalloc
+
+from benchmarks.fixtures import load_fixtures, make_page
+from vsco_downloader import preloaded
+
+
+def parse_with_regex(html):
+    """The previous way: a greedy regex and the whole state"""
+    result = re.search(
+        r'<script>window.__PRELOADED_STATE__ = (.*)</script>', html)
+    return json.loads(result.group(1))
+
+
+def parse_with_json(html):
+    orjson = preloaded.orjson
+    preloaded.orjson = None
+    try:
+        return preloaded.extract_preloaded_state(html)
+    finally:
+        preloaded.orjson = orjson
+
+
+def measure(parse, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for html in pages:
+            parse(html)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    states = [parse(html) for html in pages]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del states
+    return best, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description='First page parsing')
+    parser.add_argument('-d',
+                        '--fixture-dir',
+                        help='Saved pages, pages are generated by default')
+    parser.add_argument('-n', '--count', type=int, default=50)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.fixture_dir is None:
+        random.seed(0)
+        pages = [
+            make_page(f'user{index}', 1000 + index)
+            for index in range(args.count)
+        ]
+    elif not os.path.isdir(args.fixture_dir):
+        parser.error(f'No directory {args.fixture_dir}')
+    else:
+        pages = list(load_fixtures(args.fixture_dir).values())
+    if not pages:
+        parser.error(f'No pages in {args.fixture_dir or "memory"}')
+    size = sum(len(html) for html in pages)
+    print(f'{len(pages)} pages, {size / len(pages) / 1024:.0f} KiB per page')
+    parsers = {
+        'regex + json': parse_with_regex,
+        'find + json': parse_with_json
+    }
+    if preloaded.orjson is not None:
+        parsers['find + orjson'] = preloaded.extract_preloaded_state
+    for name, parse in parsers.items():
+        elapsed, retained = measure(parse, pages, args.repeat)
+        print(f'{name:>14}: {elapsed * 1000 / len(pages):7.3f} ms / page, '
+              f'{len(pages) / elapsed:8.0f} pages / s, '
+              f'{retained / len(pages) / 1024:7.1f} KiB kept / page')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+End-to-end throughput of ``VscoGrabber.parse_users`` against the local
+mock of vsco.co (``benchmarks.mock_server``) for scenarios:
+
+* ``huge-user`` - one user with thousands of photos,
+* ``tiny-users`` - a thousand users with a few photos each,
+* ``video-heavy`` - a few users with m3u8 videos and mini-videos,
+* ``mixed`` - users with thousands of photos and long videos.
+
+    python -m benchmarks.throughput huge-user --latency 0.02 -l 50
+
+The server and every scenario run in their own processes, so the peak RSS
+is the one of the downloader only. Files/s, MB/s, time until a half and
+90% of files are on the disk, the peak RSS and requests by kind are printed
+for every scenario.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.mock_server import (USER_PREFIX, MockVsco,
+                                    add_network_arguments)
+from vsco_downloader import container, limiter, user
+from vsco_downloader.downloader import VscoGrabber
+from vsco_downloader.session import install_uvloop
+
+# vsco.co and the content servers are different host classes of limiters
+API_HOST = 'localhost'
+CDN_HOST = '127.0.0.1'
+SERVER_START_TIMEOUT = 10
+SCENARIOS = {
+    'huge-user': {
+        'users': 1,
+        'photos': 5000,
+        'photo_size': 50 * 1024,
+    },
+    'tiny-users': {
+        'users': 1000,
+        'photos': 3,
+        'photo_size': 50 * 1024,
+    },
+    'video-heavy': {
+        'users': 4,
+        'photos': 10,
+        'mini_videos': 10,
+        'videos': 10,
+        'segments': 20,
+        'segment_size': 200 * 1024,
+    },
+    'mixed': {
+        'users': 2,
+        'photos': 1000,
+        'videos': 20,
+        'photo_size': 50 * 1024,
+        'segments': 100,
+        'segment_size': 200 * 1024,
+    },
+}
+
+
+def use_mock_endpoints(port):
+    base = f'http://{API_HOST}:{port}'
+    user.BASE_URL = f'{base}/{{user_name}}/gallery'
+    user.CONTENT_URL = (f'{base}/api/3.0/medias/profile?site_id={{user_id}}'
+                        f'&limit={{limit}}&cursor={{cursor}}')
+    container.MEDIA_URL_SCHEME = 'http://'
+    limiter.API_HOSTNAMES = {API_HOST}
+
+
+def run_server(options, port):
+    server = MockVsco(cdn_host=f'{CDN_HOST}:{port}', **options)
+    web.run_app(server.make_app(),
+                host=API_HOST,
+                port=port,
+                print=None,
+                access_log=None)
+
+
+def wait_for_port(port):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((CDN_HOST, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'The mock server is not started on {port}')
+
+
+def get_free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind((CDN_HOST, 0))
+        return free_socket.getsockname()[1]
+
+
+def get_peak_rss():
+    """:return: peak RSS of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_dir_stat(path):
+    """:return: size and modification times of files"""
+    size, times = 0, []
+    for root, _, names in os.walk(path):
+        for name in names:
+            if name.startswith('.'):
+                continue
+            stat = os.stat(os.path.join(root, name))
+            size += stat.st_size
+            times.append(stat.st_mtime)
+    return size, sorted(times)
+
+
+def get_time_until(times, started_at, share):
+    """:return: seconds until ``share`` of files are on the disk"""
+    if not times:
+        return 0.0
+    return times[max(0, int(len(times) * share) - 1)] - started_at
+
+
+async def get_server_stats(port):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'http://{CDN_HOST}:{port}/_stats') as response:
+            return await response.json()
+
+
+async def download(port, user_count, grabber_options):
+    use_mock_endpoints(port)
+    grabber = VscoGrabber(**grabber_options)
+    user_names = {f'{USER_PREFIX}{index}' for index in range(user_count)}
+    with tempfile.TemporaryDirectory() as download_path:
+        started_at = time.time()
+        await grabber.parse_users(user_names, download_path, set())
+        elapsed = time.time() - started_at
+        size, times = get_dir_stat(download_path)
+    return {
+        'seconds': elapsed,
+        'files': len(times),
+        'bytes': size,
+        'half_files': get_time_until(times, started_at, 0.5),
+        'most_files': get_time_until(times, started_at, 0.9),
+        'peak_rss': get_peak_rss(),
+        'requests': await get_server_stats(port),
+    }
+
+
+def run_client(port, user_count, grabber_options, uvloop=False):
+    if uvloop:
+        install_uvloop()
+    return asyncio.run(download(port, user_count, grabber_options))
+
+
+def run_scenario(server_options, grabber_options, uvloop=False):
+    port = get_free_port()
+    server = multiprocessing.Process(target=run_server,
+                                     args=(server_options, port),
+                                     daemon=True)
+    server.start()
+    try:
+        wait_for_port(port)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            return executor.submit(run_client, port, server_options['users'],
+                                   grabber_options, uvloop).result()
+    finally:
+        server.terminate()
+        server.join()
+
+
+def print_result(name, result):
+    seconds = result['seconds']
+    requests = ', '.join(f'{kind}: {count}'
+                         for kind, count in sorted(result['requests'].items())
+                         if kind != 'bytes')
+    print(f'{name}: {result["files"]} files, '
+          f'{result["bytes"] / 1024 / 1024:.1f} MiB in {seconds:.2f} s, '
+          f'{result["files"] / seconds:.1f} files / s, '
+          f'{result["bytes"] / 1024 / 1024 / seconds:.1f} MiB / s, '
+          f'50% files in {result["half_files"]:.2f} s, '
+          f'90% in {result["most_files"]:.2f} s, '
+          f'peak RSS {result["peak_rss"] / 1024 / 1024:.1f} MiB')
+    print(f'{" " * len(name)}  requests: {requests}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput')
+    parser.add_argument('scenarios',
+                        nargs='*',
+                        help=f'{", ".join(SCENARIOS)} (all by default)')
+    parser.add_argument('-s',
+                        '--scale',
+                        type=float,
+                        default=1.0,
+                        help='multiplier of users and media of scenarios')
+    parser.add_argument('-l', '--download-limit', type=int, default=100)
+    parser.add_argument('--uvloop', action='store_true')
+    add_network_arguments(parser)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+    network_options = {
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+    }
+    grabber_options = {
+        'download_limit': args.download_limit,
+        'video_container': 'ts',
+        'restore_datetime': False,
+    }
+    for name in args.scenarios or SCENARIOS:
+        server_options = {
+            key: (max(1, round(value * args.scale)) if key in {
+                'users', 'photos', 'mini_videos', 'videos'
+            } else value)
+            for key, value in SCENARIOS[name].items()
+        }
+        server_options.update(network_options)
+        print_result(
+            name, run_scenario(server_options, grabber_options, args.uvloop))
+
+
+if __name__ == '__main__':
+    main()
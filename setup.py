@@ -21,6 +21,11 @@ setuptools.setup(
         "aiohttp~=3.7.4",
         "aiofiles~=0.7.0",
     ],
+    extras_require={
+        'aes': ['cryptography'],
+        'uvloop': ['uvloop; sys_platform != "win32"'],
+        'orjson': ['orjson'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.7",
@@ -7,9 +7,12 @@ from functools import wraps
 from typing import List
 from asyncio.proactor_events import _ProactorBasePipeTransport
 
-from vsco_downloader.argparser import parse_arg
+from vsco_downloader.argparser import get_args, parse_arg
+from vsco_downloader.container import VscoContent
 from vsco_downloader.user import VscoUser
 from vsco_downloader.downloader import VscoGrabber
+from vsco_downloader.session import install_uvloop
+from vsco_downloader.workers import WorkerReport, log_reports, run_workers
 
 
 def py_version_checker():
@@ -18,22 +21,24 @@ def py_version_checker():
         sys.exit(f'Python < {min_major}.{min_minor} is not supported')
 
 
-async def a_main():
+async def a_main(args=None):
+    args = args or get_args()
     try:
-        init_dict, parse_dict = await parse_arg()
+        init_dict, parse_dict = await parse_arg(args)
     except ValueError as e:
         logging.error(e)
         return
-    grabber = VscoGrabber(**init_dict)
 
     st_time = time.time()
     try:
-        users: List[VscoUser] = await grabber.parse_users(**parse_dict)
-        stat_logger = logging.getLogger('Stat')
-        for user in users:
-            log = (stat_logger.warning if user.stat.has_error
-                   or user.is_invalid else stat_logger.info)
-            log(user.stat_string)
+        if args.workers > 1:
+            reports = await run_workers(args, init_dict['disabled_content'],
+                                        parse_dict)
+        else:
+            grabber = VscoGrabber(**init_dict)
+            users: List[VscoUser] = await grabber.parse_users(**parse_dict)
+            reports = [WorkerReport.from_grabber(grabber, users)]
+        log_reports(reports)
     except (KeyboardInterrupt, asyncio.CancelledError):
         logging.info('Script canceled. Finishing...')
     finally:
@@ -67,8 +72,14 @@ def main():
                           and sys.platform.startswith('win'))
     if is_new_ver_and_win:
         patch_false_positive_runtime_error()
+    args = get_args()
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+        VscoContent.keep_raw = True
+    if args.uvloop and install_uvloop():
+        logging.info('uvloop is used')
     try:
-        asyncio.run(a_main())
+        asyncio.run(a_main(args))
     except KeyboardInterrupt:
         logging.info('Finishing...')
 
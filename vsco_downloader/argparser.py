@@ -3,7 +3,15 @@ import logging
 import os
 import sys
 
+from vsco_downloader.cache import get_default_cache_path
 from vsco_downloader.container import REGISTERED_CONTENT, VscoVideo
+from vsco_downloader.dedup import DEDUP_NAME
+from vsco_downloader.limiter import API_HOST, CDN_HOST
+from vsco_downloader.manifest import MANIFEST_NAME
+from vsco_downloader.profiler import Profiler
+from vsco_downloader.ratelimit import RateLimits
+from vsco_downloader.scheduler import (DEFAULT_BUDGETS, NEWEST, ORDERS,
+                                       DownloadScheduler)
 from vsco_downloader import __version__
 
 content_types = [
@@ -12,6 +20,10 @@ content_types = [
 
 MAX_THREAD = 500
 MAX_FFMPEG_THREAD = 100
+MAX_CHUNK_SIZE = 16 * 1024
+MAX_RETRIES = 20
+MAX_WORKERS = 64
+MAX_PORT = 65535
 DOWNLOAD_PATH = 'vsco_download_path'
 
 
@@ -33,6 +45,36 @@ class MaxThread(CheckRange):
         return range(1, MAX_THREAD + 1)
 
 
+class MaxPerUserThread(CheckRange):
+    def get_check_range(self) -> range:
+        return range(0, MAX_THREAD + 1)
+
+
+class ChunkSize(CheckRange):
+    def get_check_range(self) -> range:
+        return range(1, MAX_CHUNK_SIZE + 1)
+
+
+class MaxSegmentThread(CheckRange):
+    def get_check_range(self) -> range:
+        return range(1, MAX_THREAD + 1)
+
+
+class MaxRetries(CheckRange):
+    def get_check_range(self) -> range:
+        return range(0, MAX_RETRIES + 1)
+
+
+class MaxWorkers(CheckRange):
+    def get_check_range(self) -> range:
+        return range(1, MAX_WORKERS + 1)
+
+
+class Port(CheckRange):
+    def get_check_range(self) -> range:
+        return range(0, MAX_PORT + 1)
+
+
 class MaxFFmpegThread(CheckRange):
     def get_check_range(self) -> range:
         return range(1, MAX_FFMPEG_THREAD + 1)
@@ -58,6 +100,13 @@ class FileSystemCheck(argparse.Action):
         setattr(args, self.dest, values)
 
 
+class NonNegative(argparse.Action):
+    def __call__(self, parser, args, values, option_string=None):
+        if values < 0:
+            raise argparse.ArgumentError(self, 'The value should be >= 0')
+        setattr(args, self.dest, values)
+
+
 class ListFile(FileSystemCheck):
     @property
     def is_file(self):
@@ -77,7 +126,7 @@ def get_users_from_file(file_name):
         return [user.strip().strip(';').strip(',') for user in user_file]
 
 
-async def parse_arg():
+def get_args():
     parser = argparse.ArgumentParser(description='VSCO downloader',
                                      epilog='Console VSCO downloader')
     parser.add_argument(
@@ -131,7 +180,46 @@ async def parse_arg():
         default=100,
         action=MaxThread,
         metavar='min 1; max 500',
-        help='Limit for all get request at same time. Default 100')
+        help='Limit for all get request at same time. Default 100. '
+        'The real limit is adjusted (separately for vsco.co and '
+        'for the content servers) by errors and speed of responses, '
+        'this value is the ceiling')
+    parser.add_argument('--no-adaptive-limit',
+                        action='store_true',
+                        default=False,
+                        help='Use --download-limit as is w/o adjusting')
+    parser.add_argument('--per-user-limit',
+                        type=int,
+                        default=0,
+                        action=MaxPerUserThread,
+                        metavar='min 0; max 500',
+                        help='Limit for files of one user downloaded '
+                        'at same time (inside --download-limit). '
+                        'Default 0 - only --download-limit is used')
+    for content_type, budget in DEFAULT_BUDGETS.items():
+        default_help = budget or '0 - only --download-limit is used'
+        parser.add_argument(f'--{content_type}-lane',
+                            type=int,
+                            default=budget,
+                            action=MaxPerUserThread,
+                            metavar='min 0; max 500',
+                            help=f'Limit for {content_type} files of all '
+                            f'users downloaded at same time. '
+                            f'Default {default_help}')
+    parser.add_argument('--order',
+                        choices=ORDERS,
+                        default=NEWEST,
+                        help='Order of files of a user by the type: '
+                        'newest or oldest first or the smallest first '
+                        '(files w/o size in the API are the last). '
+                        'For oldest and smallest all pages of a user are '
+                        'parsed before downloading. Default %(default)s')
+    parser.add_argument('--priority-users',
+                        nargs='+',
+                        default=[],
+                        metavar='USER',
+                        help='Files and requests of these users go first '
+                        'when lanes and limits are full')
     parser.add_argument('-f',
                         '--max-fmpeg-threads',
                         type=int,
@@ -140,6 +228,64 @@ async def parse_arg():
                         metavar='min 1; max 100',
                         help='Limit for for ffmpeg concat threads '
                         'at same time. Default 10')
+    parser.add_argument('--segment-limit',
+                        type=int,
+                        default=8,
+                        action=MaxSegmentThread,
+                        metavar='min 1; max 500',
+                        help='Limit for segments of one stream (m3u8) video '
+                        'downloaded at same time (inside --download-limit). '
+                        'Default 8')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=64,
+                        action=ChunkSize,
+                        metavar='min 1; max 16384',
+                        help='Size (KiB) of a chunk written to the disk '
+                        'while a file is downloading. Default 64')
+    parser.add_argument('--max-retries',
+                        type=int,
+                        default=4,
+                        action=MaxRetries,
+                        metavar='min 0; max 20',
+                        help='Retries of a failed request (connection error, '
+                        'timeout, 429 or 5xx status) with exponential '
+                        'backoff. Default 4')
+    parser.add_argument('--retry-budget',
+                        type=int,
+                        default=1000,
+                        help='Limit for all retries of the run. '
+                        'Default 1000')
+    parser.add_argument('--api-rate',
+                        type=float,
+                        default=0,
+                        action=NonNegative,
+                        help='Limit for requests per second to vsco.co '
+                        '(gallery pages and API). Default 0 - no limit')
+    parser.add_argument('--cdn-rate',
+                        type=float,
+                        default=0,
+                        action=NonNegative,
+                        help='Limit for requests per second to the content '
+                        'servers (photos, videos). Default 0 - no limit')
+    parser.add_argument('--api-bandwidth',
+                        type=float,
+                        default=0,
+                        action=NonNegative,
+                        help='Limit for KiB per second from vsco.co. '
+                        'Default 0 - no limit')
+    parser.add_argument('--cdn-bandwidth',
+                        type=float,
+                        default=0,
+                        action=NonNegative,
+                        help='Limit for KiB per second from the content '
+                        'servers. Default 0 - no limit')
+    parser.add_argument('--max-bandwidth',
+                        type=float,
+                        default=0,
+                        action=NonNegative,
+                        help='Limit for KiB per second of all downloads. '
+                        'Default 0 - no limit')
     parser.add_argument('-b',
                         '--black-list-user-file',
                         action=ListFile,
@@ -158,7 +304,17 @@ async def parse_arg():
                         choices=('ts', 'mp4'),
                         default='mp4',
                         help='A container for stream (m3u8) videos. '
-                        'Default "mp4", a possible alternative is "ts".')
+                        'Default "mp4", a possible alternative is "ts". '
+                        'The "ts" videos are assembled w/o ffmpeg.')
+    parser.add_argument('--pipe-to-ffmpeg',
+                        action='store_true',
+                        default=False,
+                        help='Feed segments of stream (m3u8) videos '
+                        'to ffmpeg while they are downloading '
+                        'instead of saving them to the disk before '
+                        'concatenation. Interrupted videos are not '
+                        'resumed in this mode. Encrypted videos are '
+                        'always piped.')
 
     parser.add_argument('-p',
                         '--save-parsed-download-urls',
@@ -176,6 +332,102 @@ async def parse_arg():
                         'before downloading to skip downloading '
                         'step for the files saved w/o datetime. '
                         'Pass the arg for skipping this step.')
+    parser.add_argument('-i',
+                        '--incremental',
+                        action='store_true',
+                        default=False,
+                        help='Keep a manifest of downloaded files '
+                        f'({MANIFEST_NAME}) in the download path '
+                        'and stop scraping a user on the first page '
+                        'w/o new content. Known content is skipped '
+                        'w/o checking files on the disk.')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        default=False,
+                        help='Hard link (or reflink/copy) the same media '
+                        'of several users instead of downloading it again. '
+                        f'Content hashes are kept in {DEDUP_NAME} '
+                        'in the download path')
+    parser.add_argument('--uvloop',
+                        action='store_true',
+                        default=False,
+                        help='Run with uvloop event loop (if installed)')
+    parser.add_argument('--dns-ttl',
+                        type=int,
+                        default=300,
+                        action=NonNegative,
+                        help='Seconds to cache resolved hosts. Default 300')
+    parser.add_argument('--keepalive-timeout',
+                        type=float,
+                        default=30,
+                        action=NonNegative,
+                        help='Seconds to keep an idle connection '
+                        'for reusing. Default 30')
+    parser.add_argument('--connections-per-host',
+                        type=int,
+                        default=0,
+                        action=NonNegative,
+                        help='Limit for open connections to one host. '
+                        'Default 0 - only --download-limit is used')
+    parser.add_argument('--resolve-limit',
+                        type=int,
+                        default=20,
+                        action=MaxThread,
+                        metavar='min 1; max 500',
+                        help='Limit for short links (vs.co) resolved '
+                        'at same time. Default 20')
+    parser.add_argument('--cache',
+                        action='store_true',
+                        default=False,
+                        help='Keep site ids of users, usernames of short '
+                        'links and the token in a file to skip gallery '
+                        'pages and redirects on next runs. The file is '
+                        f'{get_default_cache_path()}')
+    parser.add_argument('--cache-file',
+                        default=None,
+                        help='Use this file for the cache. Enables --cache')
+    parser.add_argument('--debug',
+                        action='store_true',
+                        default=False,
+                        help='Debug logs. Whole API records of media '
+                        'are kept in memory for them')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        default=False,
+                        help='Log wall and CPU time of stages (pages, '
+                        'downloads, videos, ffmpeg, renames) at the end')
+    parser.add_argument('--profile-trace',
+                        default=None,
+                        help='Save stages of every task to the JSON file '
+                        'for chrome://tracing or Perfetto. '
+                        'Enables --profile')
+    parser.add_argument('--profile-stats',
+                        default=None,
+                        help='Run cProfile and save the pstats file. '
+                        'Enables --profile')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=0,
+                        action=Port,
+                        metavar=f'min 0; max {MAX_PORT}',
+                        help='Serve metrics (OpenMetrics) at '
+                        'http://127.0.0.1:<port>/metrics while running. '
+                        'Default 0 - disabled')
+    parser.add_argument('--metrics-file',
+                        default=None,
+                        help='Save metrics to the JSON file at the end')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        action=MaxWorkers,
+                        metavar=f'min 1; max {MAX_WORKERS}',
+                        help='Processes with own event loops and sessions, '
+                        'users are split between them. Global limits '
+                        '(downloads, ffmpeg, connections, lanes, rates, '
+                        'retry budget) are divided between workers. '
+                        'Metrics and profile files get the worker index '
+                        '(metrics.1.json), metrics ports are '
+                        '--metrics-port + index. Default 1')
     parser.add_argument('-v',
                         '--version',
                         action='store_true',
@@ -185,6 +437,11 @@ async def parse_arg():
     if args.version:
         print(f'The script version is {__version__}.')
         sys.exit(0)
+    return args
+
+
+async def parse_arg(args=None):
+    args = args or get_args()
 
     download_path = args.download_path
     if not download_path:
@@ -197,8 +454,11 @@ async def parse_arg():
         logging.info(f'Target user count: %d', len(users))
     black_list_users = set(get_users_from_file('black_list_user_file'))
     if args.skip_existing and os.path.isdir(download_path):
-        os.listdir(download_path)
-        black_list_users |= set(os.listdir(download_path))
+        with os.scandir(download_path) as entries:
+            black_list_users |= {
+                entry.name
+                for entry in entries if entry.is_dir()
+            }
     if black_list_users:
         logging.info('Black list user count: %d', len(black_list_users))
     ffmpeg_bin = args.ffmpeg_bin
@@ -206,28 +466,96 @@ async def parse_arg():
     if 'all' in disabled_content:
         disabled_content = content_types[:-1]
 
-    if not await VscoVideo.is_ffmpeg_exists(ffmpeg_bin):
+    if (args.container_for_m3u8 != 'ts'
+            and not await VscoVideo.is_ffmpeg_exists(ffmpeg_bin)):
         logging.info(
             "ffmpeg cant's be called with '%s'. "
-            "Video content (m3u8) disabled!", ffmpeg_bin)
+            "Video content (m3u8) disabled! "
+            "Use '-c ts' to save it w/o ffmpeg.", ffmpeg_bin)
         disabled_content.append(VscoVideo.verbose_content_type)
     if len(disabled_content) == len(REGISTERED_CONTENT):
         msg = 'All content has been disabled'
         if not args.save_parsed_download_urls:
             raise ValueError(msg)
         logging.info("Only urls'll be save.")
-    init_dict = {
-        'download_limit': args.download_limit,
-        'max_ffmpeg_threads': args.max_fmpeg_threads,
-        'ffmpeg_bin': ffmpeg_bin,
-        'disabled_content': set(disabled_content),
-        'video_container': args.container_for_m3u8,
-        'save_urls_to_file': args.save_parsed_download_urls,
-        'restore_datetime': not args.no_restore_datetime
-    }
+    init_dict = get_init_dict(args, disabled_content)
     parse_dict = {
         'username_and_urls': users,
         'download_path': download_path,
         'black_list': black_list_users,
     }
     return init_dict, parse_dict
+
+
+def get_worker_file_name(file_name, index):
+    """File of the worker ``index``: stat.json -> stat.1.json"""
+    if not file_name:
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return f'{root}.{index}{extension}'
+
+
+def get_init_dict(args, disabled_content, workers=1, index=0):
+    """
+    Options of VscoGrabber. Global limits are divided by ``workers``
+    for the worker ``index``, files of metrics and profiles get its index.
+    """
+    def divide(value):
+        # 0 is no limit, any limit is at least 1
+        return max(1, value // workers) if value > 0 else value
+
+    def get_file_name(file_name):
+        if workers == 1:
+            return file_name
+        return get_worker_file_name(file_name, index)
+
+    return {
+        'download_limit': divide(args.download_limit),
+        'per_user_limit': args.per_user_limit,
+        'max_ffmpeg_threads': divide(args.max_fmpeg_threads),
+        'segment_limit': args.segment_limit,
+        'ffmpeg_bin': args.ffmpeg_bin,
+        'disabled_content': set(disabled_content),
+        'video_container': args.container_for_m3u8,
+        'pipe_to_ffmpeg': args.pipe_to_ffmpeg,
+        'save_urls_to_file': args.save_parsed_download_urls,
+        'restore_datetime': not args.no_restore_datetime,
+        'chunk_size': args.chunk_size * 1024,
+        'incremental': args.incremental,
+        'max_retries': args.max_retries,
+        'retry_budget': divide(max(args.retry_budget, 0)),
+        'adaptive_limit': not args.no_adaptive_limit,
+        'rate_limits': RateLimits(
+            request_rates={
+                API_HOST: args.api_rate / workers,
+                CDN_HOST: args.cdn_rate / workers
+            },
+            byte_rates={
+                API_HOST: args.api_bandwidth * 1024 / workers,
+                CDN_HOST: args.cdn_bandwidth * 1024 / workers
+            },
+            max_bandwidth=args.max_bandwidth * 1024 / workers),
+        'session_options': {
+            'limit_per_host': divide(args.connections_per_host),
+            'dns_ttl': args.dns_ttl,
+            'keepalive_timeout': args.keepalive_timeout,
+        },
+        'cache_file': (args.cache_file
+                       or (get_default_cache_path() if args.cache else None)),
+        'resolve_limit': divide(args.resolve_limit),
+        'dedup': args.dedup,
+        'metrics_port': (args.metrics_port +
+                         index if args.metrics_port else 0),
+        'metrics_file': get_file_name(args.metrics_file),
+        'profiler': Profiler(args.profile,
+                             get_file_name(args.profile_trace),
+                             get_file_name(args.profile_stats)),
+        'scheduler': DownloadScheduler(
+            budgets={
+                content_type: divide(
+                    getattr(args, f'{content_type.replace("-", "_")}_lane'))
+                for content_type in DEFAULT_BUDGETS
+            },
+            order=args.order,
+            priority_users=args.priority_users),
+    }
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+CACHE_NAME = 'users.json'
+# a token older than this part of the observed lifetime is not used
+TOKEN_LIFETIME_MARGIN = 0.9
+
+
+def get_default_cache_path():
+    cache_home = (os.environ.get('XDG_CACHE_HOME')
+                  or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'vsco-downloader', CACHE_NAME)
+
+
+class VscoCache:
+    """
+    Site ids of users, usernames of short links and the last bearer token,
+    kept between runs.
+    The lifetime of a token is observed as the time between its first use
+    and its first rejection, an older token is treated as expired.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._users = {}
+        self._removed_users = set()
+        self._short_urls = {}
+        self._token = None
+        self._rejected_tokens = set()
+        self._token_lifetime = None
+        self._logger = logging.getLogger('Cache')
+        self._merge(self._read())
+
+    @property
+    def path(self):
+        return self._path
+
+    def get_user_id(self, user_name) -> Optional[int]:
+        entry = self._users.get(user_name.lower())
+        return entry and entry['site_id']
+
+    def set_user_id(self, user_name, user_id):
+        user_name = user_name.lower()
+        self._removed_users.discard(user_name)
+        self._users[user_name] = {
+            'site_id': user_id,
+            'updated_at': time.time()
+        }
+
+    def invalidate_user(self, user_name):
+        user_name = user_name.lower()
+        self._users.pop(user_name, None)
+        self._removed_users.add(user_name)
+
+    def get_short_url_username(self, short_url) -> Optional[str]:
+        return self._short_urls.get(short_url)
+
+    def set_short_url_username(self, short_url, user_name):
+        self._short_urls[short_url] = user_name
+
+    def get_token(self) -> Optional[str]:
+        if not self._token:
+            return None
+        age = time.time() - self._token['seen_at']
+        if (self._token_lifetime
+                and age > self._token_lifetime * TOKEN_LIFETIME_MARGIN):
+            return None
+        return self._token['value']
+
+    def set_token(self, token):
+        now = time.time()
+        if self._token and self._token['value'] == token:
+            self._token['checked_at'] = now
+            if (self._token_lifetime and
+                    now - self._token['seen_at'] > self._token_lifetime):
+                # the token outlived the observed lifetime
+                self._token_lifetime = None
+            return
+        self._token = {'value': token, 'seen_at': now, 'checked_at': now}
+
+    def invalidate_token(self, token):
+        self._rejected_tokens.add(token)
+        if not self._token or self._token['value'] != token:
+            return
+        self._token_lifetime = time.time() - self._token['seen_at']
+        self._logger.info('Token is rejected after %.0f s',
+                          self._token_lifetime)
+        self._token = None
+
+    def save(self):
+        """Merge with the file (another run could update it) and write it"""
+        self._merge(self._read())
+        for user_name in self._removed_users:
+            self._users.pop(user_name, None)
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)),
+                    exist_ok=True)
+        # workers save the cache at the same time
+        tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(
+                {
+                    'users': self._users,
+                    'short_urls': self._short_urls,
+                    'token': self._token,
+                    'token_lifetime': self._token_lifetime
+                }, cache_file)
+        os.replace(tmp_path, self._path)
+
+    def _read(self):
+        try:
+            with open(self._path) as cache_file:
+                cache = json.load(cache_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self._logger.warning('Cache %s is not read: %s', self._path, e)
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def _merge(self, cache):
+        """Merge a read cache, invalid entries (an old format) are skipped"""
+        users = cache.get('users')
+        for user_name, entry in (users if isinstance(users, dict) else
+                                 {}).items():
+            if not isinstance(entry, dict) or not entry.get('site_id'):
+                continue
+            current = self._users.get(user_name)
+            if (not current or current.get('updated_at', 0) <
+                    entry.get('updated_at', 0)):
+                self._users[user_name] = entry
+        short_urls = cache.get('short_urls')
+        for short_url, user_name in (short_urls if isinstance(
+                short_urls, dict) else {}).items():
+            if isinstance(user_name, str):
+                self._short_urls.setdefault(short_url, user_name)
+        token = cache.get('token')
+        if (isinstance(token, dict) and token.get('value')
+                and token['value'] not in self._rejected_tokens
+                and (not self._token or self._token.get('seen_at', 0) <
+                     token.get('seen_at', 0))):
+            self._token = {'seen_at': 0, 'checked_at': 0, **token}
+        token_lifetime = cache.get('token_lifetime')
+        if (not self._token_lifetime
+                and isinstance(token_lifetime, (int, float))):
+            self._token_lifetime = token_lifetime
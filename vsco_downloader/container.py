@@ -5,32 +5,74 @@ import os
 import re
 from abc import ABC
 from pprint import pprint
-from typing import Type, Union
+from typing import List, NamedTuple, Optional, Type, Union
+from urllib.parse import urljoin
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import (Cipher, algorithms,
+                                                        modes)
+except ImportError:
+    Cipher = None
+
+AES_128 = 'AES-128'
+# scheme of media urls, the API gives them w/o it
+MEDIA_URL_SCHEME = 'https://'
+FFMPEG_FORMATS = {'ts': 'mpegts'}
+
+
+class M3u8Segment(NamedTuple):
+    url: str
+    key_method: Optional[str] = None
+    key_url: Optional[str] = None
+    iv: Optional[bytes] = None
 
 
 class VscoContent(ABC):
+    """
+    Media record with the fields used for downloading, extracted once.
+    The API dict itself is kept only with ``keep_raw`` (debug mode).
+    """
+    __slots__ = ('media_id', 'download_url', 'timestamp', 'size',
+                 '_datetime', 'raw')
     verbose_content_type = None
+    keep_raw = False
 
     def __init__(self, content_dict):
-        self._content_dict = content_dict
+        self.media_id = content_dict.get('_id') or content_dict.get('id')
+        self.download_url = self._parse_download_url(content_dict)
+        self.timestamp = (content_dict.get('captureDate')
+                          or content_dict.get('capture_date')
+                          or content_dict.get('created_date')
+                          or content_dict.get('uploadDate')
+                          or content_dict.get('last_updated'))
+        self.size = (content_dict.get('fileSize')
+                     or content_dict.get('file_size'))
+        self._datetime = None
+        self.raw = content_dict if self.keep_raw else None
+        if not self.timestamp:
+            logging.getLogger('Content').debug('Datetime were not found in %s',
+                                               content_dict)
 
-    @property
-    def download_url(self):
+    @classmethod
+    def _parse_download_url(cls, content_dict) -> Optional[str]:
         raise NotImplementedError
 
     @property
     def datetime(self):
-        capture_date = (self._content_dict.get('captureDate')
-                        or self._content_dict.get('capture_date')
-                        or self._content_dict.get('created_date')
-                        or self._content_dict.get('uploadDate')
-                        or self._content_dict.get('last_updated'))
-        if not capture_date:
+        if self._datetime is None:
+            self._datetime = self._format_datetime()
+        return self._datetime
+
+    def _format_datetime(self):
+        if not self.timestamp:
             logging.getLogger('Content').warning(
-                'Datetime were not found in %s', str(self._content_dict))
+                'Datetime were not found in %s',
+                str(self.raw or self.media_id))
             return ''
         return datetime.datetime.fromtimestamp(
-            capture_date / 1000).strftime("%Y-%m-%d_%H-%M-%S_")
+            self.timestamp / 1000).strftime("%Y-%m-%d_%H-%M-%S_")
 
     def get_original_name(self):
         if not self.download_url:
@@ -56,28 +98,31 @@ class VscoContent(ABC):
 
 
 class VscoPhoto(VscoContent):
+    __slots__ = ()
     verbose_content_type = 'photo'
 
-    @property
-    def download_url(self):
+    @classmethod
+    def _parse_download_url(cls, content_dict):
         try:
-            return 'https://' + (self._content_dict.get('responsiveUrl')
-                                 or self._content_dict.get('responsive_url'))
+            return MEDIA_URL_SCHEME + (content_dict.get('responsiveUrl')
+                                 or content_dict.get('responsive_url'))
         except TypeError:
-            pprint(self._content_dict)
+            pprint(content_dict)
             return None
 
 
 class VscoMiniVideo(VscoContent):
+    __slots__ = ()
     verbose_content_type = 'mini-video'
 
-    @property
-    def download_url(self):
-        return 'https://' + (self._content_dict.get('videoUrl')
-                             or self._content_dict.get('video_url'))
+    @classmethod
+    def _parse_download_url(cls, content_dict):
+        return MEDIA_URL_SCHEME + (content_dict.get('videoUrl')
+                             or content_dict.get('video_url'))
 
 
 class VscoVideo(VscoContent):
+    __slots__ = ('_temp_dir', )
     verbose_content_type = 'video'
 
     def __init__(self, content_dict):
@@ -87,12 +132,12 @@ class VscoVideo(VscoContent):
     def set_temp_dir(self, temp_dir):
         self._temp_dir = temp_dir
 
-    @property
-    def download_url(self):
-        return self._content_dict['playback_url']
+    @classmethod
+    def _parse_download_url(cls, content_dict):
+        return content_dict['playback_url']
 
     def get_original_name(self):
-        return self._content_dict['_id']
+        return self.media_id
 
     def get_file_name(self,
                       *download_path,
@@ -113,22 +158,133 @@ class VscoVideo(VscoContent):
             res_dict[int(ext_string.group(1))] = splitted_lines[index + 1]
         return res_dict[max(res_dict)]
 
+    @classmethod
+    def parse_segments(cls, m3u8_text, m3u8_url) -> List[M3u8Segment]:
+        segments = []
+        sequence = 0
+        key_method = key_url = iv = None
+        for line in m3u8_text.splitlines():
+            line = line.strip()
+            if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                sequence = int(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-KEY:'):
+                attributes = cls._parse_attributes(line.split(':', 1)[1])
+                key_method = attributes.get('METHOD')
+                if key_method == 'NONE':
+                    key_method = key_url = iv = None
+                    continue
+                key_url = urljoin(m3u8_url, attributes.get('URI', ''))
+                iv = attributes.get('IV')
+                iv = bytes.fromhex(iv[2:]) if iv else None
+            elif line and not line.startswith('#'):
+                segment_iv = iv
+                if key_method and not segment_iv:
+                    segment_iv = sequence.to_bytes(16, 'big')
+                segments.append(
+                    M3u8Segment(urljoin(m3u8_url, line), key_method, key_url,
+                                segment_iv))
+                sequence += 1
+        return segments
+
+    @staticmethod
+    def _parse_attributes(attributes_string):
+        return {
+            key: value.strip('"')
+            for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)',
+                                         attributes_string)
+        }
+
+    @staticmethod
+    def decrypt_segment(data, segment: M3u8Segment, key):
+        if segment.key_method != AES_128:
+            raise ValueError(
+                f'Unsupported segment encryption {segment.key_method}')
+        if Cipher is None:
+            raise ValueError('Install "cryptography" to decrypt '
+                             'AES-128 stream segments')
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(segment.iv),
+                           default_backend()).decryptor()
+        data = decryptor.update(data) + decryptor.finalize()
+        # ValueError on wrong padding (a wrong key or iv)
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        return unpadder.update(data) + unpadder.finalize()
+
     def generate_ffmpeg_concat(self, ffmpeg, files, out_file, container):
-        audio = '' if container == 'ts' else '-bsf:a aac_adtstoasc'
-        concat_string = self._generate_concat_string(files)
-        ffmpeg_cmd = (f'{ffmpeg} -hide_banner -loglevel error -y -i '
-                      f'"{concat_string}" -c copy {audio} '
-                      f'{out_file}')
-        return ffmpeg_cmd
+        return [
+            *self._ffmpeg_common_args(ffmpeg), '-i',
+            self._generate_concat_string(files),
+            *self._ffmpeg_output_args(out_file, container)
+        ]
+
+    def generate_ffmpeg_pipe(self, ffmpeg, out_file, container):
+        return [
+            *self._ffmpeg_common_args(ffmpeg), '-f', 'mpegts', '-i',
+            'pipe:0', *self._ffmpeg_output_args(out_file, container)
+        ]
+
+    @staticmethod
+    def _ffmpeg_common_args(ffmpeg):
+        return [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y']
 
     @staticmethod
-    async def run_ffmpeg(ffmpeg_cmd):
-        proc = await asyncio.create_subprocess_shell(
-            ffmpeg_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+    def _ffmpeg_output_args(out_file, container):
+        audio = [] if container == 'ts' else ['-bsf:a', 'aac_adtstoasc']
+        out_format = FFMPEG_FORMATS.get(container, container)
+        return ['-c', 'copy', *audio, '-f', out_format, out_file]
+
+    @classmethod
+    async def run_ffmpeg(cls, ffmpeg_cmd):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *ffmpeg_cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            return str(e)
         stdout, stderr = await proc.communicate()
+        return cls._decode_stderr(stderr)
+
+    @classmethod
+    async def run_ffmpeg_with_input(cls, ffmpeg_cmd, feed):
+        """
+        Run ffmpeg that reads from stdin. ``feed(write)`` streams the input,
+        ``write`` waits while the pipe is full.
+        :return: Tuple[is input fully fed, ffmpeg error or None]
+        """
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *ffmpeg_cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            return False, str(e)
+        stderr_reader = asyncio.ensure_future(proc.stderr.read())
+
+        async def write(data):
+            proc.stdin.write(data)
+            await proc.stdin.drain()
+
+        is_fed = False
+        try:
+            is_fed = await feed(write)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            if not is_fed and proc.returncode is None:
+                proc.kill()
+            proc.stdin.close()
+            stderr = await stderr_reader
+            await proc.wait()
+        error = cls._decode_stderr(stderr)
+        if is_fed and not error and proc.returncode:
+            error = f'ffmpeg exited with code {proc.returncode}'
+        return is_fed, error
+
+    @staticmethod
+    def _decode_stderr(stderr):
         if not stderr:
             return None
         try:
@@ -141,11 +297,11 @@ class VscoVideo(VscoContent):
 
     @classmethod
     async def is_ffmpeg_exists(cls, ffmpeg_bin):
-        return not await cls.run_ffmpeg(f'{ffmpeg_bin} -version')
+        return not await cls.run_ffmpeg([ffmpeg_bin, '-version'])
 
-    def _generate_concat_string(self, files):
-        return 'concat:' + '|'.join(
-            (os.path.join(self.temp_content_dir, file) for file in files))
+    @staticmethod
+    def _generate_concat_string(files):
+        return 'concat:' + '|'.join(files)
 
     @property
     def temp_content_dir(self):
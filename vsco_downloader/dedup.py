@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from typing import List, Optional
+
+from vsco_downloader.container import VscoContent
+from vsco_downloader.manifest import connect
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEDUP_NAME = '.vsco_dedup.sqlite3'
+# ioctl of Linux for a copy-on-write clone of a file (btrfs, xfs)
+FICLONE = 0x40049409
+HASH_CHUNK_SIZE = 1024 * 1024
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY = 'copy'
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as content_file:
+        for chunk in iter(lambda: content_file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_file(source, destination):
+    """
+    Hard link, reflink or (at least) copy ``source`` to ``destination``.
+    :return: the way of linking
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    part_name = f'{destination}.part'
+    # a part left by an interrupted download would fail the hard link
+    try:
+        os.remove(part_name)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, part_name)
+        method = HARDLINK
+    except OSError:
+        method = _clone_file(source, part_name)
+    os.replace(part_name, destination)
+    return method
+
+
+def _clone_file(source, destination):
+    with open(source, 'rb') as source_file, \
+            open(destination, 'wb') as destination_file:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE,
+                            source_file.fileno())
+                return REFLINK
+            except OSError:
+                pass
+        shutil.copyfileobj(source_file, destination_file)
+    return COPY
+
+
+class DedupIndex:
+    """
+    Content hashes of downloaded files and media ids/urls pointing to them,
+    stored in the download dir (shared by all users).
+    Queries (``find``, ``add``) are made out of the event loop thread
+    like calls of the manifest, linking (``link_known``, ``link_duplicate``)
+    is made in other threads.
+    """
+    def __init__(self, download_path):
+        os.makedirs(download_path, exist_ok=True)
+        self._download_path = download_path
+        self._path = os.path.join(download_path, DEDUP_NAME)
+        self._connection = connect(self._path)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS content (
+                sha256 TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS media (
+                key TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL
+            );
+        ''')
+        self.requests_avoided = 0
+        self.bytes_not_downloaded = 0
+        self.bytes_not_stored = 0
+        self._stat_lock = threading.Lock()
+        self._logger = logging.getLogger('Dedup')
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def get_keys(content: VscoContent) -> List[str]:
+        keys = [f'url:{content.download_url}']
+        if content.media_id:
+            keys.insert(0, f'id:{content.media_id}')
+        return keys
+
+    def find(self, keys) -> Optional[str]:
+        """:return: path of a present file with the same media id or url"""
+        for key in keys:
+            row = self._connection.execute(
+                'SELECT content.path, content.size FROM media '
+                'JOIN content ON media.sha256 = content.sha256 '
+                'WHERE media.key = ?', (key, )).fetchone()
+            if row and self._is_present(*row):
+                return self._get_full_path(row[0])
+        return None
+
+    def add(self, keys, sha256, path) -> Optional[str]:
+        """
+        Add a downloaded file.
+        :return: path of a present file with the same content or None
+        """
+        for key in keys:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO media VALUES (?, ?)', (key, sha256))
+        row = self._connection.execute(
+            'SELECT path, size FROM content WHERE sha256 = ?',
+            (sha256, )).fetchone()
+        relative_path = os.path.relpath(path, self._download_path)
+        if row and row[0] != relative_path and self._is_present(*row):
+            return self._get_full_path(row[0])
+        self._connection.execute(
+            'INSERT OR REPLACE INTO content VALUES (?, ?, ?)',
+            (sha256, relative_path, os.path.getsize(path)))
+        return None
+
+    def link_known(self, source, destination):
+        """Link a file of known media (see ``find``) w/o downloading it"""
+        method = link_file(source, destination)
+        size = os.path.getsize(destination)
+        with self._stat_lock:
+            self.requests_avoided += 1
+            self.bytes_not_downloaded += size
+            if method != COPY:
+                self.bytes_not_stored += size
+        self._logger.info('%s is a duplicate of %s (%s)', destination, source,
+                          method)
+
+    def link_duplicate(self, source, destination):
+        """Replace a downloaded file with a link to the same content"""
+        size = os.path.getsize(destination)
+        method = link_file(source, destination)
+        if method != COPY:
+            with self._stat_lock:
+                self.bytes_not_stored += size
+        self._logger.info('%s has the same content as %s (%s)', destination,
+                          source, method)
+
+    def close(self):
+        self._connection.close()
+
+    def _get_full_path(self, relative_path):
+        return os.path.join(self._download_path, relative_path)
+
+    def _is_present(self, relative_path, size):
+        full_path = self._get_full_path(relative_path)
+        return (os.path.isfile(full_path)
+                and os.path.getsize(full_path) == size)
+
+    def __str__(self):
+        return (f'{self.requests_avoided} requests avoided, '
+                f'{self.bytes_not_downloaded / 1024 / 1024:.1f} MiB '
+                f'not downloaded, '
+                f'{self.bytes_not_stored / 1024 / 1024:.1f} MiB not stored')
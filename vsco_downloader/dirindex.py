@@ -0,0 +1,93 @@
+import os
+import re
+from typing import Dict, Optional, Set
+
+DATETIME_PREFIX = re.compile(r'\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_')
+
+
+def has_datetime_prefix(file_name):
+    return DATETIME_PREFIX.match(file_name) is not None
+
+
+class DirectoryIndex:
+    """
+    Files of a directory from one ``os.scandir`` pass (w/o ``stat``
+    of every file where the type is known from the directory).
+    Sizes are read on demand and kept. Files written by the script are
+    added, so the directory is not checked file by file.
+    """
+    def __init__(self, path):
+        self._path = os.path.normpath(path)
+        # name -> size, None until it is read
+        self._files: Dict[str, Optional[int]] = {}
+        self._without_datetime: Set[str] = set()
+        self.scan()
+
+    @property
+    def path(self):
+        return self._path
+
+    def scan(self):
+        self._files.clear()
+        self._without_datetime.clear()
+        try:
+            with os.scandir(self._path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self._add(entry.name)
+        except FileNotFoundError:
+            pass
+
+    def has_file(self, file_path):
+        directory, name = os.path.split(file_path)
+        if os.path.normpath(directory) != self._path:
+            return os.path.isfile(file_path)
+        return name in self._files
+
+    def get_size(self, file_path):
+        """:return: size of the file or None if there is no such file"""
+        directory, name = os.path.split(file_path)
+        if os.path.normpath(directory) != self._path:
+            return (os.path.getsize(file_path)
+                    if os.path.isfile(file_path) else None)
+        if name not in self._files:
+            return None
+        size = self._files[name]
+        if size is None:
+            try:
+                size = self._files[name] = os.path.getsize(file_path)
+            except FileNotFoundError:
+                self._remove(name)
+        return size
+
+    def add(self, file_path):
+        """Add a file written to the directory"""
+        directory, name = os.path.split(file_path)
+        if os.path.normpath(directory) == self._path:
+            self._add(name)
+
+    def rename(self, old_path, new_path):
+        old_name = os.path.basename(old_path)
+        if old_name in self._files:
+            size = self._files[old_name]
+            self._remove(old_name)
+            self._add(os.path.basename(new_path), size)
+
+    def get_files_without_datetime(self, extension) -> Set[str]:
+        return {
+            name
+            for name in self._without_datetime
+            if name.endswith(f'.{extension}')
+        }
+
+    def _add(self, name, size=None):
+        self._files[name] = size
+        if not has_datetime_prefix(name):
+            self._without_datetime.add(name)
+
+    def _remove(self, name):
+        self._files.pop(name, None)
+        self._without_datetime.discard(name)
+
+    def __len__(self):
+        return len(self._files)
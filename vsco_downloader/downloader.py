@@ -1,18 +1,37 @@
 import asyncio
+import contextlib
+import itertools
 import logging
 import os
 import re
-import json
-import tempfile
+import shutil
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from glob import glob
-from typing import List, Set
+from typing import List, Optional, Set, Tuple
 
 import aiohttp
 import aiofiles
 
-from vsco_downloader.container import VscoVideo, VscoPhoto, VscoMiniVideo
-from vsco_downloader.user import VscoUser
+from vsco_downloader.cache import VscoCache
+from vsco_downloader.container import (VscoVideo, VscoPhoto, VscoMiniVideo,
+                                       VscoContent, M3u8Segment)
+from vsco_downloader.dedup import DedupIndex, hash_file
+from vsco_downloader.dirindex import DirectoryIndex
+from vsco_downloader.limiter import (API_HOST, CDN_HOST, AdaptiveLimiter,
+                                     get_host_class)
+from vsco_downloader.manifest import VscoManifest
+from vsco_downloader.metrics import MetricsServer, VscoMetrics
+from vsco_downloader.preloaded import extract_preloaded_state, loads
+from vsco_downloader.profiler import Profiler
+from vsco_downloader.ratelimit import RateLimits
+from vsco_downloader.resolver import ShortUrlResolver
+from vsco_downloader.retry import RetryPolicy
+from vsco_downloader.scheduler import LANES, DownloadScheduler
+from vsco_downloader.session import ConnectionStat, create_session
+from vsco_downloader.user import PAGE_LIMITS, VscoUser
 
 DEFAULT_HEADERS = {
     'user-agent':
@@ -23,54 +42,168 @@ DEFAULT_HEADERS = {
     'image/avif,image/webp,image/apng,*/*;'
     'q=0.8,application/signed-exchange;v=b3;q=0.9'
 }
+DEFAULT_CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = '.part'
+# ETag or Last-Modified of a .part file for If-Range on resuming
+VALIDATOR_SUFFIX = '.validator'
+CONTENT_RANGE_START = re.compile(r'bytes (\d+)-')
+PARTS_DIR_SUFFIX = '.parts'
+# statuses of the API for a too large page
+PAGE_LIMIT_REJECT_STATUSES = {400, 413, 422}
+AUTH_ERROR_STATUSES = {401, 403}
 
 
 class VscoGrabber:
     def __init__(self,
                  *,
                  download_limit: int = 100,
+                 per_user_limit: int = 0,
                  max_ffmpeg_threads: int = 10,
+                 segment_limit: int = 8,
+                 pipe_to_ffmpeg=False,
                  ffmpeg_bin: str = 'ffmpeg',
                  disabled_content: Set[str] = None,
                  video_container='mp4',
                  save_urls_to_file=False,
-                 restore_datetime=True):
-        self._semaphore = asyncio.Semaphore(download_limit)
+                 restore_datetime=True,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 incremental=False,
+                 max_retries: int = 4,
+                 retry_budget: int = 1000,
+                 adaptive_limit=True,
+                 rate_limits: Optional[RateLimits] = None,
+                 session_options: Optional[dict] = None,
+                 cache_file: Optional[str] = None,
+                 resolve_limit: int = 20,
+                 dedup=False,
+                 metrics_port: int = 0,
+                 metrics_file: Optional[str] = None,
+                 profiler: Optional[Profiler] = None,
+                 scheduler: Optional[DownloadScheduler] = None):
+        self._download_limit = download_limit
+        self._scheduler = scheduler or DownloadScheduler()
+        self._profiler = profiler or Profiler()
+        self._metrics = VscoMetrics()
+        self._metrics_port = metrics_port
+        self._metrics_file = metrics_file
+        self._limiters = {
+            host_class: AdaptiveLimiter(host_class, download_limit,
+                                        adaptive_limit, self._metrics)
+            for host_class in (API_HOST, CDN_HOST)
+        }
+        self._user_workers = per_user_limit or download_limit
         self._max_ffmpeg_concat = asyncio.Semaphore(max_ffmpeg_threads)
+        self._segment_limit = segment_limit
+        self._pipe_to_ffmpeg = pipe_to_ffmpeg
         self._ffmpeg_bin = ffmpeg_bin
         self._disabled_content = disabled_content or {}
         self._video_container = video_container
         self._save_urls_to_file = save_urls_to_file
         self._restore_datetime = restore_datetime
+        self._chunk_size = chunk_size
+        self._incremental = incremental
+        self._manifest: Optional[VscoManifest] = None
+        self._rate_limits = rate_limits or RateLimits()
+        self._retry = RetryPolicy(max_retries=max_retries,
+                                  budget=retry_budget,
+                                  metrics=self._metrics)
+        self._session_options = session_options or {}
+        self._page_limit = PAGE_LIMITS[0]
+        self._cache_file = cache_file
+        self._cache: Optional[VscoCache] = None
+        self._resolve_limit = resolve_limit
+        self._is_dedup = dedup
+        self._dedup: Optional[DedupIndex] = None
+        # one thread for calls of the manifest and the dedup index
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        # media key -> [lock, holders and waiters]
+        self._dedup_locks = {}
+        self._connection_stat = ConnectionStat()
+        self._metrics.watch_limiters(self._limiters.values())
+        self._metrics.watch_connections(self._connection_stat)
         self._content_dir = '.'
         self._logger = logging.getLogger('VSCO-GRABBER')
 
+    @property
+    def limits(self):
+        """Current concurrency limits by host class"""
+        return {
+            host_class: limiter.limit
+            for host_class, limiter in self._limiters.items()
+        }
+
+    @property
+    def connection_stat(self):
+        return self._connection_stat
+
+    @property
+    def dedup_stat(self) -> Optional[str]:
+        return str(self._dedup) if self._dedup else None
+
+    @property
+    def metrics(self) -> VscoMetrics:
+        return self._metrics
+
+    async def _run_request(self, request, url, user: VscoUser, endpoint):
+        """
+        Run ``request()`` with retries under limits of the url host.
+        Attempts are timed by ``endpoint`` (api, page, playlist, media etc.)
+        """
+        host_class = get_host_class(url)
+        return await self._retry.run(
+            lambda: self._metrics.time_request(endpoint, request),
+            url,
+            user.stat,
+            self._limiters[host_class],
+            lambda: self._rate_limits.wait_request(host_class),
+            priority=self._scheduler.get_priority(user, endpoint))
+
+    async def _add_received_bytes(self, host_class, count):
+        self._metrics.received_bytes.inc(count, host_class=host_class)
+        self._limiters[host_class].add_bytes(count)
+        await self._rate_limits.wait_bytes(host_class, count)
+
     def _parse_first_page_content(self, html):
-        result = re.search(
-            r'<script>window.__PRELOADED_STATE__ = (.*)</script>', html)
-        if not result:
+        initial_json = extract_preloaded_state(html)
+        if initial_json is None:
             self._logger.warning('Initial JSON block were not found')
             return {}
-        return json.loads(result.group(1))
+        return initial_json
 
-    @staticmethod
-    async def _get_json_with_auth(user):
+    async def _get_json_with_auth(self, user, limit):
         headers = {
             **user.scrap_session.headers, 'authorization':
             f'Bearer {user.token}'
         }
-        async with user.scrap_session.get(user.get_content_link(),
-                                          headers=headers) as request:
-            content = await request.json()
-            return content
+        url = user.get_content_link(limit)
 
-    @staticmethod
-    async def _get_html_text(user: VscoUser, url, return_also_url=False):
-        async with user.scrap_session.get(url) as request:
-            content = await request.text()
-            if return_also_url:
-                return content, request.url
-            return content
+        async def request_json():
+            async with user.scrap_session.get(url,
+                                              headers=headers) as request:
+                request.raise_for_status()
+                content = await request.read()
+                await self._add_received_bytes(get_host_class(url),
+                                               len(content))
+                return loads(content)
+
+        return await self._run_request(request_json, url, user, 'api')
+
+    async def _get_html_text(self,
+                             user: VscoUser,
+                             url,
+                             return_also_url=False,
+                             endpoint='page'):
+        async def request_text():
+            async with user.scrap_session.get(url) as request:
+                request.raise_for_status()
+                content = await request.text()
+                await self._add_received_bytes(get_host_class(url),
+                                               len(content))
+                if return_also_url:
+                    return content, request.url
+                return content
+
+        return await self._run_request(request_text, url, user, endpoint)
 
     @staticmethod
     def _get_user_id(initial_json, user_name):
@@ -114,20 +247,106 @@ class VscoGrabber:
             'tkn': None
         }})['currentUser']['tkn']
 
-    async def _parser_user_entries(self, user):
-        counter = 1
-        while user.cursor:
+    async def _get_user_page(self, user: VscoUser):
+        """
+        Request the page of the current cursor with the largest page size
+        accepted by the API. The size is shared by all users, so only
+        the first requests probe it. A rejected size is dropped only if
+        a smaller one is accepted at the same cursor, so errors of the
+        request itself (a stale cursor or token) don't lower it.
+        """
+        limit = self._page_limit
+        rejected_status = None
+        while True:
             try:
-                content = await self._get_json_with_auth(user)
-            finally:
-                user.clear_cursor()
-            user.set_cursor(content.get('next_cursor'))
-            media = content.get('media', [])
-            for image_dict in media:
+                page = await self._get_json_with_auth(user, limit)
+            except aiohttp.ClientResponseError as e:
+                smaller_limits = [
+                    page_limit for page_limit in PAGE_LIMITS
+                    if page_limit < limit
+                ]
+                if (e.status not in PAGE_LIMIT_REJECT_STATUSES
+                        or not smaller_limits):
+                    raise
+                rejected_status = e.status
+                limit = smaller_limits[0]
+                continue
+            if limit < self._page_limit:
+                self._logger.info(
+                    'Page size %d is rejected (%d). Fallback to %d',
+                    self._page_limit, rejected_status, limit)
+                self._page_limit = limit
+            return page
+
+    async def _parser_user_entries(self, user, stop_on_known=False):
+        """
+        Yield content of the first page and then of every next page.
+        The next page is requested while the current one is processed.
+        """
+        first_page_content = user.all_content.newest_first()
+        if first_page_content:
+            self._metrics.pages.inc(user=str(user))
+            yield first_page_content
+        counter = 1
+        if stop_on_known and self._is_known_page(user, first_page_content):
+            self._logger.info('First page of %s has no new content', user)
+            user.clear_cursor()
+        start_time = time.monotonic()
+        next_page = (asyncio.ensure_future(self._get_user_page(user))
+                     if user.cursor else None)
+        try:
+            while next_page:
+                try:
+                    with self._profiler.span('page', user):
+                        content = await next_page
+                except (aiohttp.ClientError, asyncio.TimeoutError,
+                        ValueError) as e:
+                    self._logger.error('Error on parsing page %d for %s: %s',
+                                       counter, user, e)
+                    return
+                finally:
+                    next_page = None
+                    user.clear_cursor()
+                page_content = self._add_page_content(user, content)
+                self._metrics.pages.inc(user=str(user))
+                self._logger.info('Page %d parsed for %s. Total content: %d',
+                                  counter, user, len(user.all_content))
+                if stop_on_known and self._is_known_page(user, page_content):
+                    self._logger.info(
+                        'Page %d of %s has no new content. '
+                        'Stop parsing', counter, user)
+                    user.clear_cursor()
+                if user.cursor:
+                    next_page = asyncio.ensure_future(
+                        self._get_user_page(user))
+                counter += 1
+                yield user.all_content.sort_newest_first(page_content)
+        finally:
+            if next_page:
+                next_page.cancel()
+            elapsed = time.monotonic() - start_time
+            if counter > 1:
+                user.stat.add_pages(counter - 1, elapsed)
+                self._logger.info('%s: %d pages parsed in %.1f s '
+                                  '(%.1f pages / s)', user, counter - 1,
+                                  elapsed, (counter - 1) / max(elapsed, 1e-6))
+        user.set_all_pages_parsed()
+
+    @staticmethod
+    def _add_page_content(user: VscoUser, content) -> List[VscoContent]:
+        """Set the next cursor and add media of an API page"""
+        user.set_cursor(content.get('next_cursor'))
+        media = content.get('media', [])
+        return [
+            content for content in (
                 user.add_content(image_dict[image_dict['type']])
-            self._logger.info('Page %d parsed for %s. Total content: %d',
-                              counter, user, len(user.all_content))
-            counter += 1
+                for image_dict in media) if content
+        ]
+
+    @staticmethod
+    def _is_known_page(user: VscoUser, page_content):
+        return bool(page_content) and all(
+            user.is_known(content) for content in page_content)
 
     async def _parse_user_page(self, initial_json, user: VscoUser):
         try:
@@ -141,6 +360,9 @@ class VscoGrabber:
                 self._logger.error("Can't parse Bearer token for %s", user)
                 return
             user.set_token(token)
+            if self._cache:
+                self._cache.set_user_id(str(user), user_id)
+                self._cache.set_token(token)
             try:
                 cursor = self._get_next_cursor(initial_json, user_id)
             except KeyError:
@@ -157,165 +379,647 @@ class VscoGrabber:
                 user.set_invalid()
             user.set_initialized()
 
-    async def _download_file(self, url, file_name, session):
+    async def _download_file(self,
+                             url,
+                             file_name,
+                             user: VscoUser,
+                             endpoint='media'):
         if not url:
             self._logger.warning('None url for %s', file_name)
             return False
-        if os.path.isfile(file_name):
+        if self._is_file_present(file_name, user):
             return None
 
         os.makedirs(os.path.dirname(file_name), exist_ok=True)
         try:
-            async with session.get(url) as request:
-                async with aiofiles.open(file_name, 'wb') as file:
-                    await file.write(await request.read())
-                    return True
-        except aiohttp.ClientError as e:
-            self._logger.error(e)
+            with self._profiler.span('download', user):
+                return await self._run_request(
+                    lambda: self._download_file_attempt(
+                        url, file_name, user, endpoint), url, user, endpoint)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.error('Error on downloading %s from %s: %s',
+                               file_name, url, str(e) or type(e).__name__)
         return False
 
+    async def _download_file_attempt(self, url, file_name, user: VscoUser,
+                                     endpoint):
+        part_name = f'{file_name}{PART_SUFFIX}'
+        validator_name = f'{part_name}{VALIDATOR_SUFFIX}'
+        validator = self._read_validator(validator_name)
+        # a part w/o a validator can't be checked, so it is restarted
+        offset = os.path.getsize(part_name) if validator and os.path.isfile(
+            part_name) else 0
+        headers = {
+            'range': f'bytes={offset}-',
+            'if-range': validator
+        } if offset else {}
+        keep_part = False
+        try:
+            async with user.download_session.get(url,
+                                                 headers=headers) as request:
+                range_start = self._get_range_start(request)
+                if offset and (request.status == 416 or
+                               (request.status == 206
+                                and range_start != offset)):
+                    self._logger.info(
+                        "Can't resume %s from %d bytes. Restarting...",
+                        file_name, offset)
+                    self._remove_part(part_name)
+                    return await self._download_file_attempt(
+                        url, file_name, user, endpoint)
+                request.raise_for_status()
+                if request.status != 206:
+                    # a new download or the file is changed (If-Range)
+                    offset = 0
+                    validator = self._get_validator(request)
+                    self._write_validator(validator_name, validator)
+                elif offset:
+                    self._logger.info('Resuming %s from %d bytes', file_name,
+                                      offset)
+                keep_part = bool(validator) and (
+                    request.status == 206 or request.headers.get(
+                        'accept-ranges', '').lower() == 'bytes')
+                expected_size = self._get_expected_size(request, offset)
+                host_class = get_host_class(url)
+                write_time = 0.0
+                async with aiofiles.open(part_name,
+                                         'ab' if offset else 'wb') as file:
+                    async for chunk in request.content.iter_chunked(
+                            self._chunk_size):
+                        write_start = time.perf_counter()
+                        await file.write(chunk)
+                        write_time += time.perf_counter() - write_start
+                        await self._add_received_bytes(host_class, len(chunk))
+                self._metrics.disk_write.observe(write_time,
+                                                 endpoint=endpoint)
+            size = os.path.getsize(part_name)
+            if expected_size is not None and size != expected_size:
+                raise aiohttp.ClientPayloadError(
+                    f'File {file_name} is incomplete: '
+                    f'{size} of {expected_size} bytes')
+            os.replace(part_name, file_name)
+            self._remove_part(part_name)
+            return True
+        finally:
+            if not keep_part:
+                self._remove_part(part_name)
+
+    @staticmethod
+    def _get_range_start(request):
+        match = CONTENT_RANGE_START.match(
+            request.headers.get('content-range', ''))
+        return int(match.group(1)) if match else None
+
+    @staticmethod
+    def _get_validator(request):
+        """A strong ETag or Last-Modified, as If-Range accepts them"""
+        etag = request.headers.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return request.headers.get('last-modified')
+
+    @staticmethod
+    def _read_validator(validator_name):
+        try:
+            with open(validator_name, encoding='utf-8') as file:
+                return file.read().strip() or None
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write_validator(validator_name, validator):
+        if not validator:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(validator_name)
+            return
+        with open(validator_name, 'w', encoding='utf-8') as file:
+            file.write(validator)
+
+    @staticmethod
+    def _remove_part(part_name):
+        """Remove a part and its validator if they exist"""
+        for name in (part_name, f'{part_name}{VALIDATOR_SUFFIX}'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(name)
+
+    @staticmethod
+    def _get_expected_size(request, offset):
+        if request.headers.get('content-encoding'):
+            return None
+        if request.content_length is None:
+            return None
+        return offset + request.content_length
+
+    def _get_out_file_name(self, file, user: VscoUser):
+        if isinstance(file, VscoVideo):
+            return file.get_file_name(self._content_dir,
+                                      str(user),
+                                      container=self._video_container)
+        return file.get_file_name(self._content_dir, str(user))
+
+    @staticmethod
+    def _is_file_present(file_name, user: VscoUser):
+        if user.dir_index is None:
+            return os.path.isfile(file_name)
+        return user.dir_index.has_file(file_name)
+
     async def _download_small_file(self, file, user):
-        return await self._download_file(
-            file.download_url, file.get_file_name(self._content_dir,
-                                                  str(user)),
-            user.download_session)
+        return await self._download_file(file.download_url,
+                                         self._get_out_file_name(file, user),
+                                         user)
 
     async def _download_large_file(self, file: VscoVideo, user: VscoUser):
-        out_file_name = file.get_file_name(self._content_dir,
-                                           str(user),
-                                           container=self._video_container)
-        if os.path.isfile(out_file_name):
+        out_file_name = self._get_out_file_name(file, user)
+        if self._is_file_present(out_file_name, user):
             return None
-        with tempfile.TemporaryDirectory() as tmp_dir_name:
-            file.set_temp_dir(tmp_dir_name)
-            try:
-                parted_url_text = await self._get_html_text(
-                    user, file.download_url)
-            except aiohttp.ClientError as e:
-                self._logger.error('Error on getting m3u8 for a file %s: %s',
-                                   out_file_name, e)
-                return False
+        with self._profiler.span('video', user):
+            downloaded = await self._download_video(file, out_file_name,
+                                                    user)
+        if downloaded:
+            self._logger.info('Video %s was downloaded', out_file_name)
+        return downloaded
+
+    async def _download_video(self, file: VscoVideo, out_file_name,
+                              user: VscoUser):
+        segments = await self._get_segments(file, user, out_file_name)
+        if not segments:
+            return False
+        is_encrypted = any(segment.key_method for segment in segments)
+        if self._video_container == 'ts':
+            return await self._assemble_ts(segments, out_file_name, user)
+        if self._pipe_to_ffmpeg or is_encrypted:
+            return await self._remux_with_ffmpeg_pipe(
+                file, segments, out_file_name, user)
+        return await self._concat_with_ffmpeg(file, segments, out_file_name,
+                                              user)
+
+    async def _get_segments(self, file: VscoVideo, user: VscoUser,
+                            out_file_name):
+        try:
+            parted_url_text = await self._get_html_text(
+                user, file.download_url, endpoint='playlist')
             parted_url = file.choice_best_resolution(parted_url_text)
             if not parted_url:
                 self._logger.error(
                     'Cant parser best resolution url for a file %s. '
                     'Skipping...', out_file_name)
-                return False
-            parted_urls_text = await self._get_html_text(user, parted_url)
-            parted_urls = re.findall(r'http[s]?://.*', parted_urls_text)
-            content_temp_dir = file.temp_content_dir
-            os.makedirs(content_temp_dir, exist_ok=True)
-            temp_files = []
-            for url in parted_urls:
-                file_name = url.split('?')[0].split('/')[-1]
-                file_name = os.path.join(content_temp_dir, file_name)
-                if (await self._download_file(url, file_name,
-                                              user.download_session)):
-                    temp_files.append(file_name)
-                else:
-                    self._logger.error('Error on downloading %s from %s', )
-                    return False
-            ffmpeg_cmd = file.generate_ffmpeg_concat(self._ffmpeg_bin,
-                                                     temp_files, out_file_name,
-                                                     self._video_container)
-            async with self._max_ffmpeg_concat:
+                return None
+            parted_urls_text = await self._get_html_text(
+                user, parted_url, endpoint='playlist')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.error('Error on getting m3u8 for a file %s: %s',
+                               out_file_name, e)
+            return None
+        segments = file.parse_segments(parted_urls_text, parted_url)
+        if not segments:
+            self._logger.error('There are no segments for a file %s',
+                               out_file_name)
+        return segments
+
+    async def _concat_with_ffmpeg(self, file: VscoVideo, segments,
+                                  out_file_name, user: VscoUser):
+        parts_dir = f'{out_file_name}{PARTS_DIR_SUFFIX}'
+        file.set_temp_dir(parts_dir)
+        content_temp_dir = file.temp_content_dir
+        os.makedirs(content_temp_dir, exist_ok=True)
+        temp_files = await self._download_segments(
+            [segment.url for segment in segments], content_temp_dir, user)
+        if temp_files is None:
+            return False
+        part_name = f'{out_file_name}{PART_SUFFIX}'
+        ffmpeg_cmd = file.generate_ffmpeg_concat(self._ffmpeg_bin, temp_files,
+                                                 part_name,
+                                                 self._video_container)
+        wait_start = time.perf_counter()
+        async with self._max_ffmpeg_concat:
+            self._metrics.ffmpeg_wait.observe(time.perf_counter() -
+                                              wait_start,
+                                              mode='concat')
+            with self._metrics.ffmpeg_run.time(
+                    mode='concat'), self._profiler.span('ffmpeg', user):
                 error = await file.run_ffmpeg(ffmpeg_cmd)
-            if error:
-                self._logger.error('Error on concat %s: %s', out_file_name,
-                                   error)
-                return False
-            self._logger.info('Video %s was downloaded', out_file_name)
+        if error:
+            self._logger.error('Error on concat %s: %s', out_file_name, error)
+            if os.path.isfile(part_name):
+                os.remove(part_name)
+            return False
+        os.replace(part_name, out_file_name)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        return True
+
+    async def _remux_with_ffmpeg_pipe(self, file: VscoVideo, segments,
+                                      out_file_name, user: VscoUser):
+        os.makedirs(os.path.dirname(out_file_name), exist_ok=True)
+        part_name = f'{out_file_name}{PART_SUFFIX}'
+        ffmpeg_cmd = file.generate_ffmpeg_pipe(self._ffmpeg_bin, part_name,
+                                               self._video_container)
+        wait_start = time.perf_counter()
+        async with self._max_ffmpeg_concat:
+            self._metrics.ffmpeg_wait.observe(time.perf_counter() -
+                                              wait_start,
+                                              mode='pipe')
+            # segments are downloaded while ffmpeg runs
+            with self._metrics.ffmpeg_run.time(
+                    mode='pipe'), self._profiler.span('ffmpeg', user):
+                is_fed, error = await file.run_ffmpeg_with_input(
+                    ffmpeg_cmd, lambda write: self._stream_segments(
+                        segments, user, write))
+        if is_fed and not error:
+            os.replace(part_name, out_file_name)
             return True
+        if error:
+            self._logger.error('Error on remux %s: %s', out_file_name, error)
+        if os.path.isfile(part_name):
+            os.remove(part_name)
+        return False
 
-    async def _download_user_content(self, user: VscoUser):
-        all_content = user.all_content
-        total_count = len(all_content)
-        if not total_count:
-            self._logger.info('User %s has no content', user)
-            return
+    async def _assemble_ts(self, segments, out_file_name, user: VscoUser):
+        os.makedirs(os.path.dirname(out_file_name), exist_ok=True)
+        part_name = f'{out_file_name}{PART_SUFFIX}'
+        assembled = False
+        write_time = 0.0
+
+        async def write(data):
+            nonlocal write_time
+            write_start = time.perf_counter()
+            await file.write(data)
+            write_time += time.perf_counter() - write_start
+
+        try:
+            async with aiofiles.open(part_name, 'wb') as file:
+                assembled = await self._stream_segments(segments, user, write)
+            self._metrics.disk_write.observe(write_time, endpoint='video')
+            if assembled:
+                os.replace(part_name, out_file_name)
+        finally:
+            if not assembled and os.path.isfile(part_name):
+                os.remove(part_name)
+        return assembled
+
+    async def _stream_segments(self, segments, user: VscoUser, write):
+        """Fetch up to ``segment_limit`` segments ahead, write them in order"""
+        keys = {}
+        tasks = deque()
+        queued = iter(segments)
+
+        def schedule_next():
+            segment = next(queued, None)
+            if segment:
+                tasks.append(
+                    asyncio.create_task(
+                        self._fetch_segment(segment, user, keys)))
+
+        try:
+            for _ in range(self._segment_limit):
+                schedule_next()
+            while tasks:
+                data = await tasks.popleft()
+                if data is None:
+                    return False
+                schedule_next()
+                await write(data)
+            return True
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch_segment(self, segment: M3u8Segment, user: VscoUser,
+                             keys):
+        key = None
+        if segment.key_method:
+            if segment.key_url not in keys:
+                keys[segment.key_url] = asyncio.ensure_future(
+                    self._fetch_bytes(segment.key_url, user, 'key'))
+            key = await asyncio.shield(keys[segment.key_url])
+            if key is None:
+                return None
+        data = await self._fetch_bytes(segment.url, user, 'segment')
+        if data is None or key is None:
+            return data
+        try:
+            return VscoVideo.decrypt_segment(data, segment, key)
+        except ValueError as e:
+            self._logger.error('Error on decrypting %s: %s', segment.url, e)
+            return None
+
+    async def _fetch_bytes(self, url, user: VscoUser, endpoint):
+        async def request_bytes():
+            async with user.download_session.get(url) as request:
+                request.raise_for_status()
+                data = await request.read()
+                await self._add_received_bytes(get_host_class(url),
+                                               len(data))
+                return data
+
+        try:
+            return await self._run_request(request_bytes, url, user,
+                                           endpoint)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._logger.error('Error on downloading %s: %s', url,
+                               str(e) or type(e).__name__)
+        return None
+
+    async def _download_segments(self, urls, content_temp_dir,
+                                 user: VscoUser):
+        fan_out = asyncio.Semaphore(self._segment_limit)
+        file_names = [
+            os.path.join(content_temp_dir,
+                         url.split('?')[0].split('/')[-1]) for url in urls
+        ]
+        tasks = [
+            asyncio.create_task(
+                self._download_segment(url, file_name, user, fan_out))
+            for url, file_name in zip(urls, file_names)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                if not await task:
+                    return None
+        finally:
+            for task in tasks:
+                task.cancel()
+        return file_names
+
+    async def _download_segment(self, url, file_name, user: VscoUser,
+                                fan_out: asyncio.Semaphore):
+        async with fan_out:
+            downloaded = await self._download_file(url, file_name, user,
+                                                   'segment')
+        return downloaded is not False
+
+    async def _download_user_content(self, user: VscoUser,
+                                     stop_on_known=False):
+        """
+        Download content while pages are parsing. Every content type
+        (lane) has own workers and a queue ordered by the scheduler.
+        The photo queue is bounded, so parsing waits for downloading.
+        Queues of videos are not, so long videos don't stop parsing.
+        For orders other than the newest first (the order of pages)
+        all pages are parsed before downloading, so the whole user is
+        ordered, not only files in queues.
+        """
         user_dir = os.path.join(self._content_dir, str(user))
-        if self._save_urls_to_file:
-            os.makedirs(user_dir, exist_ok=True)
-            log_name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S_urls.txt")
-            log_name = os.path.join(user_dir, log_name)
-            async with aiofiles.open(log_name, 'w') as log_file:
-                await log_file.write('\n'.join(
-                    [str(file.download_url) for file in all_content]))
         photo_verbose, video_verbose = [
             content.verbose_content_type
             for content in (VscoPhoto, VscoMiniVideo)
         ]
+        user.dir_index = DirectoryIndex(user_dir)
         rename_dict = {photo_verbose: set(), video_verbose: set()}
         if self._restore_datetime:
-            rename_dict = self._get_rename_dict(user_dir, photo_verbose,
-                                                video_verbose)
+            rename_dict = self._get_rename_dict(user.dir_index,
+                                                photo_verbose, video_verbose)
+        url_log_name = None
+        if self._save_urls_to_file:
+            url_log_name = datetime.now().strftime(
+                "%Y-%m-%d_%H-%M-%S_urls.txt")
+            url_log_name = os.path.join(user_dir, url_log_name)
         self._logger.info('Start downloading files for %s', user)
-        async with aiohttp.ClientSession(
-                headers=DEFAULT_HEADERS) as user.download_session:
-            for index, file in enumerate(all_content.copy(), 1):
-                content_type = file.verbose_content_type
-                need_to_rename = (file.get_original_name()
-                                  in rename_dict.get(content_type, set()))
-                if need_to_rename:
-                    self._rename_file(file, user_dir)
-                if file.verbose_content_type in self._disabled_content:
-                    user.stat.add_skipped(file)
-                    continue
-                async with self._semaphore:
-                    if isinstance(file, VscoVideo):
-                        downloaded = await self._download_large_file(
-                            file, user)
-                    else:
-                        downloaded = await self._download_small_file(
-                            file, user)
-                if downloaded:
-                    user.stat.add_downloaded(file)
-                elif downloaded is None:
-                    user.stat.add_skipped(file)
-
-                if not index % 10:
-                    self._logger.info('%s: (%d / %d)', user, index,
-                                      total_count)
+        buffered = self._scheduler.is_buffered
+        photo_queue_size = 0 if buffered else self._user_workers * 2
+        queues = {
+            lane: asyncio.PriorityQueue(
+                maxsize=photo_queue_size if lane == photo_verbose else 0)
+            for lane in LANES
+        }
+        workers = {lane: [] for lane in LANES}
+
+        def add_worker(lane):
+            if len(workers[lane]) < self._scheduler.get_workers(
+                    lane, self._user_workers):
+                workers[lane].append(
+                    asyncio.create_task(
+                        self._download_worker(queues[lane], lane, user,
+                                              user_dir, rename_dict)))
+
+        try:
+            async for page_content in self._parser_user_entries(
+                    user, stop_on_known):
+                if url_log_name:
+                    await self._save_urls(url_log_name, page_content)
+                for file in page_content:
+                    lane = self._scheduler.get_lane(file)
+                    if not buffered:
+                        add_worker(lane)
+                    await self._put_item(queues[lane],
+                                         self._scheduler.make_item(file),
+                                         workers[lane])
+            if buffered:
+                for lane, queue in queues.items():
+                    for _ in range(queue.qsize()):
+                        add_worker(lane)
+            for lane, lane_workers in workers.items():
+                for _ in lane_workers:
+                    await self._put_item(queues[lane],
+                                         self._scheduler.make_item(None),
+                                         lane_workers)
+            await asyncio.gather(*itertools.chain(*workers.values()))
+        finally:
+            for worker in itertools.chain(*workers.values()):
+                worker.cancel()
+        total_count = len(user.all_content)
+        if not total_count:
+            self._logger.info('User %s has no content', user)
+        elif total_count % 10:
+            self._logger.info('%s: (%d / %d)', user, total_count,
+                              total_count)
 
     @staticmethod
-    def _find_files_with_out_date(
-        path,
-        extension,
-    ):
-        match_pattern = r'\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_.*?'
-        files = {
-            os.path.basename(file)
-            for file in glob(f'{path}/*.{extension}')
-        }
-        if not files:
-            return set(), 0
-        content_set = set(
-            filter(lambda file: not re.match(match_pattern, file), files))
-        return content_set, len(content_set)
+    async def _put_item(queue: asyncio.Queue, item, workers):
+        """
+        Put an item to a bounded queue while its workers are alive,
+        a worker is done only after the end of a lane, else it failed
+        """
+        if not queue.full():
+            queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(queue.put(item))
+        try:
+            await asyncio.wait([put, *workers],
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+        if put.done() and not put.cancelled():
+            return
+        for worker in workers:
+            if worker.done():
+                # raises the error of the worker
+                worker.result()
+        raise RuntimeError('Download workers are stopped')
+
+    @staticmethod
+    async def _save_urls(url_log_name, page_content):
+        os.makedirs(os.path.dirname(url_log_name), exist_ok=True)
+        async with aiofiles.open(url_log_name, 'a') as log_file:
+            await log_file.write(''.join(
+                [f'{file.download_url}\n' for file in page_content]))
+
+    async def _download_worker(self, queue: asyncio.PriorityQueue, lane,
+                               user: VscoUser, user_dir, rename_dict):
+        while True:
+            *_, file = await queue.get()
+            if file is None:
+                return
+            async with self._scheduler.lane_slot(lane, user):
+                try:
+                    await self._download_content(file, user, user_dir,
+                                                 rename_dict)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # e.g. OSError of a full disk, the next file can pass
+                    self._logger.error('Error on downloading %s of %s: %r',
+                                       file.get_original_name(), user, e)
+                    self._count_file(file, 'failed')
+            processed = user.add_processed()
+            if not processed % 10:
+                self._logger.info('%s: (%d / %d)', user, processed,
+                                  len(user.all_content))
+
+    async def _download_content(self, file, user: VscoUser, user_dir,
+                                rename_dict):
+        if self._manifest and user.is_known(file):
+            user.stat.add_skipped(file)
+            self._count_file(file, 'known')
+            return
+        content_type = file.verbose_content_type
+        need_to_rename = (file.get_original_name()
+                          in rename_dict.get(content_type, set()))
+        if need_to_rename:
+            with self._profiler.span('rename', user):
+                self._rename_file(file, user_dir, user.dir_index)
+        if file.verbose_content_type in self._disabled_content:
+            user.stat.add_skipped(file)
+            self._count_file(file, 'disabled')
+            return
+        downloaded = await self._download_media(file, user)
+        if downloaded:
+            user.dir_index.add(self._get_out_file_name(file, user))
+            user.stat.add_downloaded(file)
+            self._count_file(file, 'downloaded')
+        elif downloaded is None:
+            user.stat.add_skipped(file)
+            self._count_file(file, 'present')
+        else:
+            self._count_file(file, 'failed')
+        if self._manifest and downloaded is not False:
+            await self._add_to_manifest(file, user)
+
+    def _count_file(self, file, result):
+        self._metrics.files.inc(content_type=file.verbose_content_type,
+                                result=result)
+
+    async def _download_media(self, file, user: VscoUser):
+        download = (self._download_large_file if isinstance(
+            file, VscoVideo) else self._download_small_file)
+        if not self._dedup:
+            return await download(file, user)
+        out_file_name = self._get_out_file_name(file, user)
+        if self._is_file_present(out_file_name, user):
+            return None
+        keys = self._dedup.get_keys(file)
+        # the same media of another user waits for the first download
+        async with self._dedup_lock(keys[0]):
+            try:
+                source = await self._run_db(self._dedup.find, keys)
+                if source:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self._dedup.link_known, source, out_file_name)
+                    return True
+            except (OSError, sqlite3.Error) as e:
+                self._logger.error("Can't link %s: %s", out_file_name, e)
+            downloaded = await download(file, user)
+            if downloaded:
+                await self._deduplicate_file(keys, out_file_name)
+        return downloaded
 
-    def _get_rename_dict(self, user_dir, photo_key, video_key):
+    @contextlib.asynccontextmanager
+    async def _dedup_lock(self, key):
+        """Lock of a media, dropped when nobody holds or waits for it"""
+        entry = self._dedup_locks.get(key)
+        if entry is None:
+            entry = self._dedup_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._dedup_locks[key]
+
+    async def _deduplicate_file(self, keys, file_name):
+        try:
+            sha256 = await asyncio.get_running_loop().run_in_executor(
+                None, hash_file, file_name)
+            same_file = await self._run_db(self._dedup.add, keys, sha256,
+                                           file_name)
+            if same_file:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._dedup.link_duplicate, same_file, file_name)
+        except (OSError, sqlite3.Error) as e:
+            self._logger.error('Error on deduplication of %s: %s', file_name,
+                               e)
+
+    async def _run_db(self, method, *args):
+        """Call ``method`` of the manifest or the dedup index in its thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._db_executor, method, *args)
+
+    async def _add_to_manifest(self, file, user: VscoUser):
+        size = user.dir_index.get_size(self._get_out_file_name(file, user))
+        try:
+            await self._run_db(self._manifest.add, str(user), file, size)
+        except sqlite3.Error as e:
+            self._logger.error('Error on adding %s to the manifest: %s',
+                               file.download_url, e)
+
+    async def _load_manifest(self, user: VscoUser):
+        """:return: is it allowed to stop parsing on a known page"""
+        if not self._manifest:
+            return False
+        try:
+            user.set_known_media_ids(await self._run_db(
+                self._manifest.get_known_ids, str(user)))
+            return await self._run_db(self._manifest.is_complete, str(user))
+        except sqlite3.Error as e:
+            self._logger.error('Error on reading the manifest for %s: %s',
+                               user, e)
+            return False
+
+    async def _save_manifest(self, user: VscoUser):
+        if not self._manifest:
+            return
+        try:
+            await self._run_db(
+                self._manifest.set_synced, str(user),
+                user.is_all_pages_parsed and not user.stat.has_error)
+        except sqlite3.Error as e:
+            self._logger.error('Error on saving the manifest for %s: %s',
+                               user, e)
+
+    def _get_rename_dict(self, dir_index: DirectoryIndex, photo_key,
+                         video_key):
         rename_dict = {photo_key: set(), video_key: set()}
-        photo_count = video_count = 0
         if VscoPhoto.verbose_content_type not in self._disabled_content:
-            rename_dict[
-                photo_key], photo_count = self._find_files_with_out_date(
-                    user_dir, 'jpg')
-        if VscoVideo.verbose_content_type not in self._disabled_content:
-            rename_dict[
-                video_key], video_count = self._find_files_with_out_date(
-                    user_dir, 'mp4')
+            rename_dict[photo_key] = dir_index.get_files_without_datetime(
+                'jpg')
+        if VscoMiniVideo.verbose_content_type not in self._disabled_content:
+            rename_dict[video_key] = dir_index.get_files_without_datetime(
+                'mp4')
         common_warn = 'Detected %d %s with out datetime in the %s'
-        if photo_count:
-            self._logger.warning(common_warn, photo_count, 'photos', user_dir)
-        if photo_count:
-            self._logger.warning(common_warn, video_count, 'videos', user_dir)
+        for key, verbose in ((photo_key, 'photos'), (video_key, 'videos')):
+            if rename_dict[key]:
+                self._logger.warning(common_warn, len(rename_dict[key]),
+                                     verbose, dir_index.path)
         return rename_dict
 
-    def _rename_file(self, file, user_dir):
+    def _rename_file(self, file, user_dir, dir_index: DirectoryIndex):
         origin_name = file.get_file_name(user_dir, datetime_prefix=False)
         name_with_datetime = file.get_file_name(user_dir)
         try:
             os.rename(origin_name, name_with_datetime)
+            dir_index.rename(origin_name, name_with_datetime)
             self._logger.info(f"Renamed file '%s' with out datetime to '%s'",
                               origin_name, name_with_datetime)
             return True
@@ -324,6 +1028,41 @@ class VscoGrabber:
                                origin_name, name_with_datetime, e)
             return False
 
+    async def _parser_first_api_page(self, user: VscoUser):
+        """
+        Init a user with the site id and the token from the cache:
+        the first page is requested from the API w/o the gallery page.
+        :return: False if there is no cache for the user or it is outdated
+        """
+        if not self._cache or user.is_inited_with_short:
+            return False
+        user_id = self._cache.get_user_id(str(user))
+        token = self._cache.get_token()
+        if not user_id or not token:
+            return False
+        self._logger.info('Getting first page for %s from the API', user)
+        user.set_user_id(user_id)
+        user.set_token(token)
+        try:
+            content = await self._get_user_page(user)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self._logger.warning(
+                'Cached site id or token of %s is not used (%s). '
+                'Getting gallery page', user, e)
+            if (isinstance(e, aiohttp.ClientResponseError)
+                    and e.status in AUTH_ERROR_STATUSES):
+                self._cache.invalidate_user(str(user))
+                self._cache.invalidate_token(token)
+            user.clear_cursor()
+            return False
+        self._cache.set_token(token)
+        self._add_page_content(user, content)
+        if user.cursor is None and not user.all_content:
+            self._logger.info('User %s has no content', user)
+            user.set_invalid()
+        user.set_initialized()
+        return True
+
     async def _parser_first_page(self, user):
         try:
             is_short_init = user.is_inited_with_short
@@ -345,7 +1084,7 @@ class VscoGrabber:
             else:
                 content = await self._get_html_text(user, user.user_url)
 
-        except aiohttp.ClientError as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             user.set_invalid()
             self._logger.error('Error on parse page %s', e)
             return
@@ -386,24 +1125,46 @@ class VscoGrabber:
         usernames, short_urls = self._get_splitted_user_sets(
             usernames_and_urls)
         bl_usernames, bl_short_urls = self._get_splitted_user_sets(black_list)
-        if bl_short_urls:
-            self._logger.warning('Black list contains short links. '
-                                 'They will be ignored!')
+        # vs.co is a host of vsco.co
+        resolver = ShortUrlResolver(
+            session,
+            self._retry,
+            self._resolve_limit,
+            self._cache,
+            limiter=self._limiters[API_HOST],
+            rate_limit=lambda: self._rate_limits.wait_request(API_HOST),
+            priority=self._scheduler.get_priority(None, 'api'))
+        if short_urls or bl_short_urls:
+            self._logger.info('Resolving %d short links',
+                              len(short_urls | bl_short_urls))
+        resolved = await resolver.resolve_all(short_urls | bl_short_urls)
+        bl_usernames.update(resolved[short_url] for short_url in bl_short_urls
+                            if resolved[short_url])
+        unresolved = []
+        for short_url in short_urls:
+            user_name = resolved[short_url]
+            if not user_name:
+                unresolved.append(short_url)
+            elif user_name in usernames:
+                self._logger.info(
+                    'Removed %s from usernames. '
+                    'This username grabbed with short', user_name)
+            else:
+                usernames.add(user_name)
         source_len = len(usernames)
         usernames -= bl_usernames
         if len(usernames) != source_len:
             self._logger.info(
                 '%d blacklisted users have '
                 'been removed from targets', source_len - len(usernames))
-        if not short_urls:
-            self._logger.debug('There are no short links')
+        if not unresolved:
             return [VscoUser(username, session) for username in usernames]
-        self._logger.info(f'Inited %d users with short url', len(short_urls))
-        pre_inited_users = [
-            VscoUser(short_url, session, True) for short_url in short_urls
-        ]
-        inited_users: List[VscoUser] = await asyncio.gather(
-            *[self.parse_user(user, True) for user in pre_inited_users])
+        # the last chance for unresolved links: the whole page
+        self._logger.info('Inited %d users with short url', len(unresolved))
+        inited_users: List[VscoUser] = await asyncio.gather(*[
+            self.parse_user(VscoUser(short_url, session, True), True)
+            for short_url in unresolved
+        ])
         for user in inited_users:
             repeat = str(user) in usernames
             if repeat:
@@ -419,28 +1180,129 @@ class VscoGrabber:
                           username_and_urls: Set[str],
                           download_path='.',
                           black_list=None):
-        async with aiohttp.ClientSession(
-                headers=DEFAULT_HEADERS) as scrap_session:
+        # the limiters bound requests of each host class
+        if self._cache_file:
+            self._cache = VscoCache(self._cache_file)
+        metrics_server = None
+        if self._metrics_port:
+            metrics_server = MetricsServer(self._metrics, self._metrics_port)
+            try:
+                await metrics_server.start()
+            except OSError as e:
+                self._logger.error("Can't serve metrics at port %d: %s",
+                                   self._metrics_port, e)
+                metrics_server = None
+        self._profiler.start()
+        try:
+            return await self._parse_users(username_and_urls, download_path,
+                                           black_list)
+        finally:
+            self._profiler.stop()
+            if self._cache:
+                self._save_cache()
+                self._cache = None
+            if metrics_server:
+                await metrics_server.stop()
+            if self._metrics_file:
+                self._dump_metrics()
+
+    async def resolve_targets(self,
+                              username_and_urls: Set[str],
+                              black_list=None
+                              ) -> Tuple[List[str], List[VscoUser]]:
+        """
+        Usernames of targets w/o blacklisted users: urls are parsed,
+        short links are resolved (by the whole page as the last chance).
+        :return: sorted usernames and users of invalid short links
+        """
+        if self._cache_file:
+            self._cache = VscoCache(self._cache_file)
+        try:
+            async with create_session(
+                    DEFAULT_HEADERS,
+                    limit=self._download_limit * len(self._limiters),
+                    connection_stat=self._connection_stat,
+                    **self._session_options) as session:
+                users = await self._restore_users(
+                    username_and_urls, session, (black_list or {}))
+        finally:
+            if self._cache:
+                self._save_cache()
+                self._cache = None
+        usernames = {str(user) for user in users if not user.is_invalid}
+        return sorted(usernames), [user for user in users if user.is_invalid]
+
+    def _dump_metrics(self):
+        try:
+            self._metrics.dump(self._metrics_file)
+            self._logger.info('Metrics are saved to %s', self._metrics_file)
+        except OSError as e:
+            self._logger.error('Error on saving metrics %s: %s',
+                               self._metrics_file, e)
+
+    def _save_cache(self):
+        try:
+            self._cache.save()
+        except OSError as e:
+            self._logger.error('Error on saving cache %s: %s',
+                               self._cache.path, e)
+
+    async def _parse_users(self, username_and_urls, download_path,
+                           black_list):
+        async with create_session(
+                DEFAULT_HEADERS,
+                limit=self._download_limit * len(self._limiters),
+                connection_stat=self._connection_stat,
+                **self._session_options) as session:
             self._content_dir = download_path
-            users = await self._restore_users(username_and_urls, scrap_session,
+            users = await self._restore_users(username_and_urls, session,
                                               (black_list or {}))
+            for user in users:
+                user.download_session = session
             if not users:
                 self._logger.warning(
                     'There are no users for download. Stopping...')
                 return []
+            if self._incremental or self._is_dedup:
+                self._db_executor = ThreadPoolExecutor(max_workers=1)
+            if self._incremental:
+                self._manifest = await self._run_db(VscoManifest,
+                                                    download_path)
+                self._logger.info('Incremental sync with %s',
+                                  self._manifest.path)
+            if self._is_dedup:
+                # closed at the end, but kept for the stat
+                self._dedup = await self._run_db(DedupIndex, download_path)
+                self._logger.info('Deduplication with %s', self._dedup.path)
             try:
                 users = await asyncio.gather(
                     *[self.parse_user(user) for user in users])
             except (KeyboardInterrupt, asyncio.CancelledError):
                 self._logger.info('Stopping...')
+            finally:
+                await self._close_db()
         return users
 
+    async def _close_db(self):
+        if self._manifest:
+            await self._run_db(self._manifest.close)
+            self._manifest = None
+        if self._dedup:
+            await self._run_db(self._dedup.close)
+        if self._db_executor:
+            self._db_executor.shutdown()
+            self._db_executor = None
+
     async def parse_user(self, vsco_user: VscoUser, only_init=False):
         if vsco_user.is_invalid:
             return vsco_user
         if not vsco_user.is_inited:
-            await self._parser_first_page(vsco_user)
+            with self._profiler.span('first_page', vsco_user):
+                if not await self._parser_first_api_page(vsco_user):
+                    await self._parser_first_page(vsco_user)
         if not only_init and not vsco_user.is_invalid:
-            await self._parser_user_entries(vsco_user)
-            await self._download_user_content(vsco_user)
+            stop_on_known = await self._load_manifest(vsco_user)
+            with self._profiler.span('user', vsco_user):
+                await self._download_user_content(vsco_user, stop_on_known)
+            await self._save_manifest(vsco_user)
         return vsco_user
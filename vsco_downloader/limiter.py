@@ -0,0 +1,177 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+API_HOST = 'api'
+CDN_HOST = 'cdn'
+API_HOSTNAMES = {'vsco.co', 'www.vsco.co'}
+INITIAL_LIMIT = 10
+DECREASE_FACTOR = 0.5
+GOODPUT_TOLERANCE = 0.9
+LATENCY_FACTOR = 3
+
+
+def get_host_class(url):
+    """API for vsco.co pages and REST, CDN for images/videos"""
+    hostname = urlparse(str(url)).hostname or ''
+    return API_HOST if hostname in API_HOSTNAMES else CDN_HOST
+
+
+def is_throttled(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    return (isinstance(error, aiohttp.ClientResponseError)
+            and (error.status == 429 or error.status >= 500))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit of requests to a host class.
+    The limit grows by one after ``limit`` successful requests if goodput
+    (bytes or requests per second) didn't drop and latency didn't blow up,
+    and halves on 429/5xx/timeouts (once per window of requests).
+    Like TCP, it doubles instead of +1 until the first throttling or
+    until goodput stops growing (slow start).
+    Waiting requests get free slots by priority (lower first), then FIFO.
+    """
+    def __init__(self, name, max_limit, adaptive=True, metrics=None):
+        self._name = name
+        self._max_limit = max_limit
+        self._limit = min(max_limit, INITIAL_LIMIT) if adaptive else max_limit
+        self._adaptive = adaptive
+        self._active = 0
+        # heap of (priority, order, future) of waiting requests
+        self._waiters = []
+        self._order = itertools.count()
+        self._epoch = 0
+        self._window_start = time.monotonic()
+        self._window_done = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_throttled = False
+        self._last_goodput = 0.0
+        self._min_latency = None
+        self._is_slow_start = adaptive
+        self._metrics = metrics
+        self._logger = logging.getLogger('Limiter')
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def active(self):
+        return self._active
+
+    def slot(self, priority=0):
+        return _LimiterSlot(self, priority)
+
+    def add_bytes(self, count):
+        self._window_bytes += count
+
+    async def _acquire(self, priority=0):
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        self._wake_waiters()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # a cancelled waiter is skipped, a given slot is returned
+            if not waiter.cancelled():
+                self._active -= 1
+                self._wake_waiters()
+            raise
+        if self._metrics:
+            self._metrics.limiter_wait.observe(time.monotonic() - start,
+                                               host_class=self._name)
+        return self._epoch
+
+    async def _release(self, epoch, latency, error):
+        if self._adaptive:
+            if error is None:
+                self._on_success(latency)
+            elif is_throttled(error):
+                self._on_throttle(epoch, error)
+        self._active -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        while self._waiters and self._active < self._limit:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                continue
+            self._active += 1
+            waiter.set_result(None)
+
+    def _on_success(self, latency):
+        self._window_done += 1
+        self._window_latency += latency
+        if self._min_latency is None or latency < self._min_latency:
+            self._min_latency = latency
+        if self._window_done < self._limit:
+            return
+        elapsed = max(time.monotonic() - self._window_start, 1e-6)
+        goodput = (self._window_bytes or self._window_done) / elapsed
+        average_latency = self._window_latency / self._window_done
+        is_improved = goodput >= self._last_goodput * GOODPUT_TOLERANCE
+        is_latency_ok = (average_latency <=
+                         self._min_latency * LATENCY_FACTOR)
+        if self._is_slow_start and goodput <= self._last_goodput:
+            self._is_slow_start = False
+        if (not self._window_throttled and self._limit < self._max_limit
+                and is_improved and (is_latency_ok or goodput >
+                                     self._last_goodput)):
+            step = self._limit if self._is_slow_start else 1
+            self._limit = min(self._max_limit, self._limit + step)
+            self._logger.debug('%s limit increased to %d', self._name,
+                               self._limit)
+        self._last_goodput = goodput
+        self._reset_window()
+
+    def _on_throttle(self, epoch, error):
+        if epoch != self._epoch:
+            self._window_throttled = True
+            return
+        self._epoch += 1
+        self._is_slow_start = False
+        new_limit = max(1, int(self._limit * DECREASE_FACTOR))
+        if new_limit != self._limit:
+            self._limit = new_limit
+            self._logger.info('%s limit decreased to %d (%s)', self._name,
+                              self._limit,
+                              str(error) or type(error).__name__)
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_done = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+        self._window_throttled = False
+
+
+class _LimiterSlot:
+    def __init__(self, limiter: AdaptiveLimiter, priority=0):
+        self._limiter = limiter
+        self._priority = priority
+        self._epoch = None
+        self._start = None
+
+    async def __aenter__(self):
+        self._epoch = await self._limiter._acquire(self._priority)
+        self._start = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._limiter._release(self._epoch,
+                                     time.monotonic() - self._start, exc)
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import time
+from typing import Set
+
+from vsco_downloader.container import VscoContent
+
+MANIFEST_NAME = '.vsco_manifest.sqlite3'
+# seconds to wait for a lock of the db held by another worker
+SQLITE_TIMEOUT = 30
+
+
+def connect(path):
+    """
+    Connection for several processes (workers): every statement is committed
+    at once (no lock is held between statements), readers don't wait for
+    writers (WAL). The connection can be used from another thread
+    (one at a time).
+    """
+    connection = sqlite3.connect(path,
+                                 timeout=SQLITE_TIMEOUT,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+class VscoManifest:
+    """
+    Downloaded media of every user, stored in the download dir.
+    Calls block on the disk and on locks of other workers, so they are made
+    out of the event loop thread.
+    """
+    def __init__(self, download_path):
+        os.makedirs(download_path, exist_ok=True)
+        self._path = os.path.join(download_path, MANIFEST_NAME)
+        self._connection = connect(self._path)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS media (
+                username TEXT NOT NULL,
+                media_id TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                url TEXT,
+                size INTEGER,
+                capture_date INTEGER,
+                PRIMARY KEY (username, media_id)
+            );
+            CREATE TABLE IF NOT EXISTS user_sync (
+                username TEXT PRIMARY KEY,
+                synced_at INTEGER NOT NULL,
+                complete INTEGER NOT NULL
+            );
+        ''')
+
+    @property
+    def path(self):
+        return self._path
+
+    def get_known_ids(self, username) -> Set[str]:
+        cursor = self._connection.execute(
+            'SELECT media_id FROM media WHERE username = ?', (username, ))
+        return {media_id for media_id, in cursor}
+
+    def is_complete(self, username):
+        """Whether a previous sync of the user walked all the pages"""
+        row = self._connection.execute(
+            'SELECT complete FROM user_sync WHERE username = ?',
+            (username, )).fetchone()
+        return bool(row and row[0])
+
+    def add(self, username, content: VscoContent, size=None):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?)',
+            (username, content.media_id, content.verbose_content_type,
+             content.download_url, size, content.timestamp))
+
+    def set_synced(self, username, complete):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO user_sync VALUES (?, ?, ?)',
+            (username, int(time.time()), int(complete)))
+
+    def close(self):
+        self._connection.close()
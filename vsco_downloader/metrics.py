@@ -0,0 +1,348 @@
+import json
+import logging
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+OPENMETRICS_CONTENT_TYPE = ('application/openmetrics-text; version=1.0.0; '
+                            'charset=utf-8')
+# seconds, like the default buckets of Prometheus clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+PREFIX = 'vsco_'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n'))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return f'{{{",".join(pairs)}}}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = f'{PREFIX}{name}'
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def _get_key(self, labels) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [
+            f'# TYPE {self.name} {self.type_name}',
+            f'# HELP {self.name} {_escape(self.documentation)}',
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self):
+        raise NotImplementedError
+
+    def to_dict(self):
+        return {
+            'type': self.type_name,
+            'help': self.documentation,
+            'samples': self._get_samples(),
+        }
+
+    def _get_samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonic value by labels, ``callback`` reads it from elsewhere"""
+    type_name = 'counter'
+
+    def __init__(self,
+                 name,
+                 documentation,
+                 label_names=(),
+                 callback: Optional[Callable[[], Dict[tuple, float]]] = None):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[tuple, float] = {}
+        self._callback = callback
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._read().get(self._get_key(labels), 0)
+
+    def _read(self):
+        return self._callback() if self._callback else self._values
+
+    def _render_samples(self):
+        return [
+            f'{self.name}_total{_format_labels(self.label_names, key)} '
+            f'{_format_value(value)}'
+            for key, value in sorted(self._read().items())
+        ]
+
+    def _get_samples(self):
+        return [{
+            'labels': dict(zip(self.label_names, key)),
+            'value': value
+        } for key, value in sorted(self._read().items())]
+
+
+class Gauge(Counter):
+    """Current value by labels"""
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._get_key(labels)] = value
+
+    def _render_samples(self):
+        return [
+            f'{self.name}{_format_labels(self.label_names, key)} '
+            f'{_format_value(value)}'
+            for key, value in sorted(self._read().items())
+        ]
+
+
+class Histogram(_Metric):
+    """Counts of observed values by buckets, their sum and count"""
+    type_name = 'histogram'
+
+    def __init__(self,
+                 name,
+                 documentation,
+                 label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self._buckets = tuple(sorted(buckets)) + (float('inf'), )
+        # labels -> [bucket counts, sum, count]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self._buckets), 0.0, 0]
+        for index, bound in enumerate(self._buckets):
+            if value <= bound:
+                entry[0][index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels):
+        """Observe the time of a ``with`` block"""
+        return _Timer(self, labels)
+
+    def get_sum(self, **labels):
+        entry = self._values.get(self._get_key(labels))
+        return entry[1] if entry else 0.0
+
+    def get_count(self, **labels):
+        entry = self._values.get(self._get_key(labels))
+        return entry[2] if entry else 0
+
+    def _iter_cumulative(self, counts):
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            yield bound, cumulative
+
+    def _render_samples(self):
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            for bound, cumulative in self._iter_cumulative(counts):
+                labels = _format_labels(self.label_names, key,
+                                        ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_count{labels} {count}')
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        return lines
+
+    def _get_samples(self):
+        return [{
+            'labels': dict(zip(self.label_names, key)),
+            'buckets': {
+                _format_value(bound): cumulative
+                for bound, cumulative in self._iter_cumulative(counts)
+            },
+            'sum': total,
+            'count': count,
+        } for key, (counts, total, count) in sorted(self._values.items())]
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start,
+                                **self._labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """:return: metrics in the OpenMetrics text format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {
+            name: metric.to_dict()
+            for name, metric in self._metrics.items()
+        }
+
+    def dump(self, file_name):
+        with open(file_name, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+
+
+class MetricsServer:
+    """Local HTTP endpoint ``/metrics`` for a Prometheus scraper"""
+    def __init__(self, registry: MetricsRegistry, port, host='127.0.0.1'):
+        self._registry = registry
+        self._port = port
+        self._host = host
+        self._runner: Optional[web.AppRunner] = None
+        self._logger = logging.getLogger('Metrics')
+
+    async def start(self):
+        """Raise OSError if the port is busy"""
+        app = web.Application()
+        app.router.add_get('/metrics', self._get_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self._host, self._port).start()
+        except OSError:
+            await self.stop()
+            raise
+        self._logger.info('Metrics are served at http://%s:%d/metrics',
+                          self._host, self._port)
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _get_metrics(self, request):
+        return web.Response(
+            body=self._registry.render().encode(),
+            headers={'Content-Type': OPENMETRICS_CONTENT_TYPE})
+
+
+class VscoMetrics(MetricsRegistry):
+    """Metrics of a run: where the time goes (API, CDN, ffmpeg, disk)"""
+    def __init__(self):
+        super().__init__()
+        self.request_duration = self.register(
+            Histogram('request_duration_seconds',
+                      'Time of request attempts by endpoint type',
+                      ('endpoint', )))
+        self.requests = self.register(
+            Counter('requests',
+                    'Request attempts by endpoint type and result '
+                    '(ok, status or error)', ('endpoint', 'result')))
+        self.received_bytes = self.register(
+            Counter('received_bytes', 'Received bytes by host class',
+                    ('host_class', )))
+        self.limiter_wait = self.register(
+            Histogram('limiter_wait_seconds',
+                      'Wait for a slot of the concurrency limit',
+                      ('host_class', )))
+        self.retries = self.register(
+            Counter('retries', 'Retries by reason (status or error)',
+                    ('reason', )))
+        self.retry_delay = self.register(
+            Counter('retry_delay_seconds', 'Delays before retries'))
+        self.ffmpeg_wait = self.register(
+            Histogram('ffmpeg_wait_seconds', 'Wait for a free ffmpeg slot',
+                      ('mode', )))
+        self.ffmpeg_run = self.register(
+            Histogram('ffmpeg_run_seconds', 'Run time of ffmpeg',
+                      ('mode', )))
+        self.disk_write = self.register(
+            Histogram('disk_write_seconds',
+                      'Time of writing of a file to the disk',
+                      ('endpoint', )))
+        self.pages = self.register(
+            Counter('pages', 'Parsed pages by user', ('user', )))
+        self.files = self.register(
+            Counter('files', 'Files by content type and result',
+                    ('content_type', 'result')))
+
+    def watch_limiters(self, limiters):
+        """Export current limits and requests in flight of limiters"""
+        self.register(
+            Gauge('active_connections',
+                  'Connections in use (requests in flight) by host class',
+                  ('host_class', ),
+                  callback=lambda: {(limiter.name, ): limiter.active
+                                    for limiter in limiters}))
+        self.register(
+            Gauge('concurrency_limit',
+                  'Current concurrency limit by host class',
+                  ('host_class', ),
+                  callback=lambda: {(limiter.name, ): limiter.limit
+                                    for limiter in limiters}))
+
+    def watch_connections(self, connection_stat):
+        self.register(
+            Counter('connections',
+                    'Opened connections by reuse (new or reused)',
+                    ('state', ),
+                    callback=lambda: {
+                        ('new', ): connection_stat.created,
+                        ('reused', ): connection_stat.reused,
+                    }))
+
+    async def time_request(self, endpoint, request):
+        """Await ``request()`` and count its time and result"""
+        result = 'ok'
+        start = time.perf_counter()
+        try:
+            return await request()
+        except aiohttp.ClientResponseError as e:
+            result = str(e.status)
+            raise
+        except BaseException as e:
+            result = type(e).__name__
+            raise
+        finally:
+            self.request_duration.observe(time.perf_counter() - start,
+                                          endpoint=endpoint)
+            self.requests.inc(endpoint=endpoint, result=result)
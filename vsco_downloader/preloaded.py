@@ -0,0 +1,67 @@
+import json
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STATE_START = '<script>window.__PRELOADED_STATE__ = '
+SCRIPT_END = '</script>'
+# subtrees of the state used for a user, everything else is dropped
+STATE_PATHS = (
+    ('sites', 'siteByUsername'),
+    ('entities', 'images'),
+    ('medias', 'bySiteId'),
+    ('users', 'currentUser', 'tkn'),
+)
+
+
+def loads(text):
+    """``orjson.loads`` if orjson is installed, ``json.loads`` otherwise"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def find_preloaded_state(html) -> Optional[str]:
+    """JSON text of the state script w/o copying the rest of the page"""
+    start = html.find(STATE_START)
+    if start == -1:
+        return None
+    start += len(STATE_START)
+    end = html.find(SCRIPT_END, start)
+    if end == -1:
+        return None
+    return html[start:end].rstrip().rstrip(';')
+
+
+def trim_state(state) -> dict:
+    """Copy only ``STATE_PATHS`` of the state (with the same nesting)"""
+    trimmed = {}
+    for path in STATE_PATHS:
+        value = state
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            node = trimmed
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = value
+    return trimmed
+
+
+def extract_preloaded_state(html) -> Optional[dict]:
+    """:return: trimmed state or None if the page has no valid state"""
+    state_text = find_preloaded_state(html)
+    if state_text is None:
+        return None
+    try:
+        state = loads(state_text)
+    except ValueError:
+        return None
+    if not isinstance(state, dict):
+        return None
+    return trim_state(state)
@@ -0,0 +1,288 @@
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from collections.abc import Coroutine
+from typing import Dict, List, Optional
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class StageStat:
+    __slots__ = ('count', 'wall', 'cpu', 'max_wall')
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def add(self, wall, cpu):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.max_wall = max(self.max_wall, wall)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'max_wall': self.max_wall
+        }
+
+
+class _StepTimer(Coroutine):
+    """
+    Coroutine of a task which counts CPU time of every step of the task,
+    so a span gets CPU time of its own task only, not of tasks running
+    while it awaits
+    """
+    def __init__(self, coro, profiler: 'Profiler'):
+        self._coro = coro
+        self._profiler = profiler
+        self._cpu = 0.0
+        self._step_start = 0.0
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coro.throw, *args)
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def _step(self, method, *args):
+        outer_step = self._profiler.current_step
+        self._profiler.current_step = self
+        self._step_start = time.thread_time()
+        try:
+            return method(*args)
+        finally:
+            self._cpu += time.thread_time() - self._step_start
+            self._profiler.current_step = outer_step
+
+    def get_cpu(self):
+        """CPU time of finished steps and of the running one"""
+        return self._cpu + time.thread_time() - self._step_start
+
+    @property
+    def wrapped(self):
+        return self._coro
+
+
+class _Span:
+    __slots__ = ('_profiler', '_stage', '_user', '_start', '_step',
+                 '_cpu_start', '_task')
+
+    def __init__(self, profiler: 'Profiler', stage, user):
+        self._profiler = profiler
+        self._stage = stage
+        self._user = user
+        self._start = None
+        self._step: Optional[_StepTimer] = None
+        self._cpu_start = 0.0
+        self._task = None
+
+    def __enter__(self):
+        self._step = self._profiler.current_step
+        if self._step is not None:
+            self._cpu_start = self._step.get_cpu()
+        else:
+            self._cpu_start = time.thread_time()
+        self._task = self._profiler.get_task_id()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._start
+        if self._step is not None:
+            cpu = self._step.get_cpu() - self._cpu_start
+        else:
+            # out of profiled tasks: CPU of other tasks is counted too
+            cpu = time.thread_time() - self._cpu_start
+        self._profiler.add_span(self._stage, self._user, self._task,
+                                self._start, wall, cpu)
+        return False
+
+
+class Profiler:
+    """
+    Wall and CPU time of stages (spans) by stage and by user.
+    Disabled profiler spans do nothing. Optionally cProfile of the event
+    loop thread is saved as a pstats file and spans as a Chrome trace
+    (chrome://tracing, Perfetto) with a track for every task.
+    """
+    def __init__(self,
+                 enabled=False,
+                 trace_file: Optional[str] = None,
+                 stats_file: Optional[str] = None):
+        self._enabled = enabled or bool(trace_file or stats_file)
+        self._trace_file = trace_file
+        self._stats_file = stats_file
+        self._stages: Dict[str, StageStat] = defaultdict(StageStat)
+        self._user_stages: Dict[str, Dict[str, StageStat]] = defaultdict(
+            lambda: defaultdict(StageStat))
+        self._spans: List[tuple] = []
+        self._task_ids = {}
+        self._last_task_id = 0
+        self._task_names: Dict[int, str] = {}
+        self._origin = time.perf_counter()
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._previous_factory = None
+        self.current_step: Optional[_StepTimer] = None
+        self._logger = logging.getLogger('Profile')
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def span(self, stage, user=None):
+        """Context manager timing a stage (``with`` over awaits too)"""
+        if not self._enabled:
+            return NULL_SPAN
+        return _Span(self, stage, user)
+
+    def start(self):
+        """Start profiling in the running loop"""
+        if not self._enabled:
+            return
+        loop = asyncio.get_running_loop()
+        self._previous_factory = loop.get_task_factory()
+        loop.set_task_factory(self._create_task)
+        self._origin = time.perf_counter()
+        if self._stats_file:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        """Stop profiling, log the summary and save files"""
+        if not self._enabled:
+            return
+        asyncio.get_running_loop().set_task_factory(self._previous_factory)
+        if self._cprofile:
+            self._cprofile.disable()
+            self._save(self._stats_file, self._cprofile.dump_stats)
+            self._cprofile = None
+        if self._trace_file:
+            self._save(self._trace_file, self._write_trace)
+        self._logger.info('Stages (wall / CPU, s):\n%s', self.summary())
+
+    def _create_task(self, loop, coro, **kwargs):
+        coro = _StepTimer(coro, self)
+        if self._previous_factory:
+            return self._previous_factory(loop, coro, **kwargs)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    def get_task_id(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return 0
+        task_id = self._task_ids.get(task)
+        if task_id is None:
+            self._last_task_id += 1
+            task_id = self._task_ids[task] = self._last_task_id
+            self._task_names[task_id] = self._get_task_name(task)
+            # finished tasks are not kept
+            task.add_done_callback(self._task_ids.pop)
+        return task_id
+
+    @staticmethod
+    def _get_task_name(task):
+        name = getattr(task, 'get_name', lambda: '')()
+        coro = task.get_coro() if hasattr(task, 'get_coro') else None
+        coro = getattr(coro, 'wrapped', coro)
+        qualname = getattr(coro, '__qualname__', '')
+        return f'{name} {qualname}'.strip()
+
+    def add_span(self, stage, user, task_id, start, wall, cpu):
+        self._stages[stage].add(wall, cpu)
+        if user is not None:
+            self._user_stages[str(user)][stage].add(wall, cpu)
+        if self._trace_file:
+            self._spans.append((stage, user, task_id, start, wall, cpu))
+
+    def summary(self):
+        return '\n'.join(
+            f'{stage:>12}: {stat.count:6d} x, {stat.wall:9.2f} / '
+            f'{stat.cpu:8.2f}, max {stat.max_wall:.2f}'
+            for stage, stat in sorted(self._stages.items(),
+                                      key=lambda item: -item[1].wall))
+
+    def to_dict(self):
+        return {
+            'stages': {
+                stage: stat.to_dict()
+                for stage, stat in self._stages.items()
+            },
+            'users': {
+                user: {
+                    stage: stat.to_dict()
+                    for stage, stat in stages.items()
+                }
+                for user, stages in self._user_stages.items()
+            },
+        }
+
+    def _write_trace(self, file_name):
+        pid = os.getpid()
+        events = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': task_id,
+            'args': {
+                'name': name
+            }
+        } for task_id, name in self._task_names.items()]
+        for stage, user, task_id, start, wall, cpu in self._spans:
+            events.append({
+                'name': stage,
+                'cat': 'stage',
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': wall * 1e6,
+                'pid': pid,
+                'tid': task_id,
+                'args': {
+                    'user': str(user) if user is not None else None,
+                    'cpu_ms': cpu * 1000
+                },
+            })
+        with open(file_name, 'w') as trace_file:
+            json.dump({
+                'traceEvents': events,
+                'otherData': self.to_dict()
+            }, trace_file)
+
+    def _save(self, file_name, write):
+        try:
+            write(file_name)
+            self._logger.info('Profile is saved to %s', file_name)
+        except OSError as e:
+            self._logger.error('Error on saving profile %s: %s', file_name, e)
@@ -0,0 +1,65 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from vsco_downloader.limiter import API_HOST, CDN_HOST
+
+
+class TokenBucket:
+    """
+    ``rate`` tokens per second with a burst of ``capacity`` tokens.
+    A consumer takes tokens at once (the balance may go below zero)
+    and sleeps until its debt is paid, so waiters are served in order.
+    """
+    def __init__(self, rate, capacity=None):
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    async def consume(self, amount=1):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens +
+                           (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+class RateLimits:
+    """Requests and bytes per second by host class plus a global bandwidth"""
+    def __init__(self,
+                 request_rates: Optional[Dict[str, float]] = None,
+                 byte_rates: Optional[Dict[str, float]] = None,
+                 max_bandwidth: float = 0):
+        request_rates = request_rates or {}
+        byte_rates = byte_rates or {}
+        self._request_buckets = {
+            host_class: self._create_bucket(request_rates.get(host_class))
+            for host_class in (API_HOST, CDN_HOST)
+        }
+        self._byte_buckets = {
+            host_class: self._create_bucket(byte_rates.get(host_class))
+            for host_class in (API_HOST, CDN_HOST)
+        }
+        self._bandwidth_bucket = self._create_bucket(max_bandwidth)
+
+    @staticmethod
+    def _create_bucket(rate) -> Optional[TokenBucket]:
+        return TokenBucket(rate) if rate and rate > 0 else None
+
+    async def wait_request(self, host_class):
+        bucket = self._request_buckets[host_class]
+        if bucket:
+            await bucket.consume()
+
+    async def wait_bytes(self, host_class, count):
+        for bucket in (self._byte_buckets[host_class],
+                       self._bandwidth_bucket):
+            if bucket:
+                await bucket.consume(count)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+
+from vsco_downloader.cache import VscoCache
+from vsco_downloader.limiter import API_HOSTNAMES, AdaptiveLimiter
+from vsco_downloader.retry import RetryPolicy
+from vsco_downloader.user import VscoUser
+
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+# statuses of servers w/o HEAD support
+NO_HEAD_STATUSES = {405, 501}
+
+
+def normalize_short_url(short_url):
+    """vs.co/abc for https://vs.co/abc/, http://vs.co/abc etc."""
+    parsed = urlparse(short_url if '://' in short_url else
+                      f'https://{short_url}')
+    return f'{parsed.netloc.lower()}{parsed.path.rstrip("/")}'
+
+
+class ShortUrlResolver:
+    """
+    Usernames of vs.co links by their redirects w/o downloading pages.
+    Redirects are followed by HEAD requests until the first vsco.co url
+    with a username. Requests are made under ``limiter`` and ``rate_limit``
+    of vsco.co like other requests to it.
+    """
+    def __init__(self,
+                 session: aiohttp.ClientSession,
+                 retry: RetryPolicy,
+                 limit=20,
+                 cache: Optional[VscoCache] = None,
+                 limiter: Optional[AdaptiveLimiter] = None,
+                 rate_limit: Optional[Callable[[], Awaitable]] = None,
+                 priority=0):
+        self._session = session
+        self._retry = retry
+        self._limiter = limiter
+        self._rate_limit = rate_limit
+        self._priority = priority
+        self._semaphore = asyncio.Semaphore(limit)
+        self._cache = cache
+        self._logger = logging.getLogger('Resolver')
+
+    async def resolve_all(
+            self, short_urls: Iterable[str]) -> Dict[str, Optional[str]]:
+        """:return: {short url: username or None if it is not resolved}"""
+        short_urls = list(short_urls)
+        usernames = await asyncio.gather(
+            *[self.resolve(short_url) for short_url in short_urls])
+        return dict(zip(short_urls, usernames))
+
+    async def resolve(self, short_url) -> Optional[str]:
+        key = normalize_short_url(short_url)
+        if self._cache:
+            user_name = self._cache.get_short_url_username(key)
+            if user_name:
+                return user_name
+        async with self._semaphore:
+            try:
+                user_name = await self._follow_redirects(f'https://{key}')
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    ValueError) as e:
+                self._logger.warning("Can't resolve %s: %s", short_url, e)
+                return None
+        if not user_name:
+            self._logger.warning("Can't resolve %s: no redirect to vsco.co",
+                                 short_url)
+            return None
+        self._logger.info('Mapped username %s for url %s', user_name,
+                          short_url)
+        if self._cache:
+            self._cache.set_short_url_username(key, user_name)
+        return user_name
+
+    async def _follow_redirects(self, url) -> Optional[str]:
+        for _ in range(MAX_REDIRECTS):
+            location = await self._retry.run(lambda: self._get_location(url),
+                                             url,
+                                             limiter=self._limiter,
+                                             rate_limit=self._rate_limit,
+                                             priority=self._priority)
+            if not location:
+                return None
+            url = urljoin(url, location)
+            if urlparse(url).hostname in API_HOSTNAMES:
+                user_name, _ = VscoUser.get_username_from_full_url(url)
+                return user_name
+        return None
+
+    async def _get_location(self, url) -> Optional[str]:
+        async with self._session.head(url,
+                                      allow_redirects=False) as response:
+            if response.status in NO_HEAD_STATUSES:
+                return await self._get_location_with_get(url)
+            return self._read_location(response)
+
+    async def _get_location_with_get(self, url) -> Optional[str]:
+        async with self._session.get(url, allow_redirects=False) as response:
+            return self._read_location(response)
+
+    @staticmethod
+    def _read_location(response: aiohttp.ClientResponse) -> Optional[str]:
+        if response.status in REDIRECT_STATUSES:
+            return response.headers.get('Location')
+        response.raise_for_status()
+        return None
@@ -0,0 +1,130 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+
+import aiohttp
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+RETRY_AFTER_STATUSES = {429, 503}
+
+
+class RetryBudget:
+    """Retries shared by all requests of the run"""
+    def __init__(self, total):
+        self._left = total
+
+    @property
+    def left(self):
+        return self._left
+
+    def take(self):
+        if self._left <= 0:
+            return False
+        self._left -= 1
+        return True
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter for connection errors, timeouts and
+    retryable statuses. ``Retry-After`` of 429/503 has priority.
+    """
+    def __init__(self,
+                 max_retries=4,
+                 base_delay=1.0,
+                 max_delay=60.0,
+                 budget=1000,
+                 metrics=None):
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._budget = RetryBudget(budget)
+        self._is_budget_warned = False
+        self._metrics = metrics
+        self._logger = logging.getLogger('Retry')
+
+    async def run(self,
+                  request,
+                  description,
+                  stat=None,
+                  limiter=None,
+                  rate_limit=None,
+                  priority=0):
+        """
+        Call ``request()`` until it succeeds or retries are over.
+        ``rate_limit()`` is awaited before every attempt. A slot of
+        ``limiter`` is held only while a request is running, not while
+        waiting for the rate limit or for the next attempt.
+        Slots are given to requests of lower ``priority`` first.
+        """
+        retry = 0
+        while True:
+            try:
+                if rate_limit is not None:
+                    await rate_limit()
+                if limiter is None:
+                    return await request()
+                async with limiter.slot(priority):
+                    return await request()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self.get_delay(retry, e)
+                if delay is None or not self._take_budget():
+                    raise
+                retry += 1
+                self._logger.warning('%s: %s. Retry %d / %d in %.1f s',
+                                     description,
+                                     str(e) or type(e).__name__, retry,
+                                     self._max_retries, delay)
+                if stat is not None:
+                    stat.add_retry(delay)
+                if self._metrics:
+                    self._metrics.retries.inc(reason=self._get_reason(e))
+                    self._metrics.retry_delay.inc(delay)
+                await asyncio.sleep(delay)
+
+    def get_delay(self, retry, error):
+        """:return: delay before the next attempt or None to give up"""
+        if retry >= self._max_retries or isinstance(error,
+                                                    aiohttp.InvalidURL):
+            return None
+        if isinstance(error, aiohttp.ClientResponseError):
+            if error.status not in RETRY_STATUSES:
+                return None
+            if error.status in RETRY_AFTER_STATUSES:
+                retry_after = self._parse_retry_after(error.headers)
+                if retry_after is not None:
+                    return min(retry_after, self._max_delay)
+        delay = min(self._max_delay, self._base_delay * 2**retry)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _get_reason(error):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return str(error.status)
+        return type(error).__name__
+
+    def _take_budget(self):
+        if self._budget.take():
+            return True
+        if not self._is_budget_warned:
+            self._is_budget_warned = True
+            self._logger.warning('Retry budget is over. '
+                                 'Failed requests are not retried anymore')
+        return False
+
+    @staticmethod
+    def _parse_retry_after(headers):
+        value = (headers or {}).get('retry-after')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_date.timestamp() - time.time())
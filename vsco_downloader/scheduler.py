@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import itertools
+from typing import Dict, Iterable, Optional
+
+from vsco_downloader.container import (VscoContent, VscoMiniVideo, VscoPhoto,
+                                       VscoVideo)
+
+LANES = tuple(content_type.verbose_content_type
+              for content_type in (VscoPhoto, VscoMiniVideo, VscoVideo))
+NEWEST = 'newest'
+OLDEST = 'oldest'
+SMALLEST = 'smallest'
+ORDERS = (NEWEST, OLDEST, SMALLEST)
+DEFAULT_BUDGETS = {
+    VscoPhoto.verbose_content_type: 0,
+    VscoMiniVideo.verbose_content_type: 16,
+    VscoVideo.verbose_content_type: 16,
+}
+PRIORITY_USER = 0
+USER = 1
+# requests of pages go first, then of photos/mini-videos, then of videos
+ENDPOINT_PRIORITIES = {
+    'api': 0,
+    'page': 0,
+    'media': 1,
+    'playlist': 2,
+    'key': 2,
+    'segment': 2,
+}
+
+
+class _Unbounded:
+    def slot(self, priority=0):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class _LaneBudget:
+    """
+    Semaphore of a lane: waiting files get free slots by priority
+    (lower first), then FIFO, like waiters of ``AdaptiveLimiter``
+    """
+    def __init__(self, budget):
+        self._free = budget
+        # heap of (priority, order, future) of waiting files
+        self._waiters = []
+        self._order = itertools.count()
+
+    def slot(self, priority=0):
+        return _LaneSlot(self, priority)
+
+    async def _acquire(self, priority=0):
+        if self._free and not self._waiters:
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # a cancelled waiter is skipped, a given slot is passed on
+            if not waiter.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # the slot goes to the waiter w/o being freed
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+
+class _LaneSlot:
+    def __init__(self, budget: _LaneBudget, priority=0):
+        self._budget = budget
+        self._priority = priority
+
+    async def __aenter__(self):
+        await self._budget._acquire(self._priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._budget._release()
+        return False
+
+
+class DownloadScheduler:
+    """
+    Lanes of content types with budgets of files downloaded at same time
+    by all users, so long videos don't hold slots of quick photos.
+    Files of a lane are taken by ``order``: newest or oldest first or
+    the smallest first (shortest job first, files w/o size are the last).
+    Pages come newest first, so for other orders all pages of a user
+    are parsed before downloading (``is_buffered``).
+    When budgets of lanes and limits are full, files and requests
+    of priority users go first, then requests by endpoint: pages,
+    photos and mini-videos, video segments.
+    """
+    def __init__(self,
+                 budgets: Optional[Dict[str, int]] = None,
+                 order=NEWEST,
+                 priority_users: Iterable[str] = ()):
+        if order not in ORDERS:
+            raise ValueError(f'Unknown order {order}')
+        self._budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self._order = order
+        self._priority_users = set(priority_users)
+        self._lane_budgets = {
+            lane: _LaneBudget(budget) if budget else _Unbounded()
+            for lane, budget in self._budgets.items()
+        }
+        self._counter = itertools.count()
+
+    @property
+    def is_buffered(self):
+        """
+        Whether all files of a user are queued before downloading:
+        pages come newest first, other orders need the whole user
+        """
+        return self._order != NEWEST
+
+    @staticmethod
+    def get_lane(file: VscoContent):
+        return file.verbose_content_type
+
+    def get_workers(self, lane, user_workers):
+        """Workers of a user for a lane"""
+        budget = self._budgets[lane]
+        return min(budget, user_workers) if budget else user_workers
+
+    def lane_slot(self, lane, user=None):
+        """A slot of the lane budget, files of priority users go first"""
+        return self._lane_budgets[lane].slot(self._get_user_priority(user))
+
+    def get_priority(self, user, endpoint):
+        """:return: priority of a request for limiters (lower first)"""
+        return (self._get_user_priority(user),
+                ENDPOINT_PRIORITIES.get(endpoint, 0))
+
+    def _get_user_priority(self, user):
+        return (PRIORITY_USER
+                if str(user) in self._priority_users else USER)
+
+    def get_sort_key(self, file: VscoContent):
+        timestamp = file.timestamp or 0
+        if self._order == OLDEST:
+            return timestamp,
+        if self._order == SMALLEST:
+            return file.size is None, file.size or 0, -timestamp
+        return -timestamp,
+
+    def make_item(self, file: Optional[VscoContent]):
+        """
+        Item of a lane queue (``asyncio.PriorityQueue``),
+        None (the end of a lane) goes after all files
+        """
+        if file is None:
+            return True, (), next(self._counter), None
+        return False, self.get_sort_key(file), next(self._counter), file
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+import aiohttp
+
+DEFAULT_DNS_TTL = 300
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+
+
+class ConnectionStat:
+    """New and reused connections of a session (by its trace config)"""
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_connection_create_end.append(self._on_create)
+        self.trace_config.on_connection_reuseconn.append(self._on_reuse)
+
+    async def _on_create(self, session, context, params):
+        self.created += 1
+
+    async def _on_reuse(self, session, context, params):
+        self.reused += 1
+
+    def __str__(self):
+        total = self.created + self.reused
+        reused_percent = self.reused * 100 / total if total else 0
+        return (f'{total} connections: {self.created} new, '
+                f'{self.reused} reused ({reused_percent:.0f}%)')
+
+
+def create_session(headers,
+                   limit=100,
+                   limit_per_host=0,
+                   dns_ttl=DEFAULT_DNS_TTL,
+                   keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                   connection_stat: ConnectionStat = None):
+    """
+    One pool of connections for the whole run.
+    ``dns_ttl`` or ``keepalive_timeout`` equal to 0 disables
+    the DNS cache or keep-alive connections.
+    """
+    connector_options = {
+        'limit': limit,
+        'limit_per_host': limit_per_host,
+        'use_dns_cache': bool(dns_ttl),
+        'ttl_dns_cache': dns_ttl or None,
+    }
+    if keepalive_timeout:
+        connector_options['keepalive_timeout'] = keepalive_timeout
+    else:
+        connector_options['force_close'] = True
+    return aiohttp.ClientSession(
+        headers=headers,
+        connector=aiohttp.TCPConnector(**connector_options),
+        trace_configs=([connection_stat.trace_config]
+                       if connection_stat else None))
+
+
+def install_uvloop():
+    """:return: True if the uvloop policy is set"""
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning('uvloop is not installed, the default loop is used')
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
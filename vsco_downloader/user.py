@@ -1,11 +1,13 @@
 import re
 import urllib
-from typing import Set, Type, Dict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Type
 
 from vsco_downloader.container import (VscoPhoto, VscoMiniVideo, VscoVideo,
                                        VscoContent)
 
 DEFAULT_LIMIT = 14
+# page sizes to probe, the largest one accepted by the API is used
+PAGE_LIMITS = (100, 50, 30, DEFAULT_LIMIT)
 BASE_URL = 'https://vsco.co/{user_name}/gallery'
 CONTENT_URL = ('https://vsco.co/api/3.0/medias/profile?site_id={user_id}'
                '&limit={limit}'
@@ -63,6 +65,10 @@ class VscoUserStat:
             content_type.verbose_content_type: VscoContentStat(content_type)
             for content_type in (VscoPhoto, VscoMiniVideo, VscoVideo)
         }
+        self._retry_count = 0
+        self._retry_delay = 0.0
+        self._page_count = 0
+        self._page_time = 0.0
 
     def add_total(self, content_type, count=1):
         self._content[content_type.verbose_content_type].add_total(count)
@@ -73,19 +79,87 @@ class VscoUserStat:
     def add_skipped(self, content_type, count=1):
         self._content[content_type.verbose_content_type].add_skipped(count)
 
+    def add_retry(self, delay):
+        self._retry_count += 1
+        self._retry_delay += delay
+
+    @property
+    def retry_count(self):
+        return self._retry_count
+
+    def add_pages(self, count, elapsed):
+        self._page_count += count
+        self._page_time += elapsed
+
+    @property
+    def pages_per_second(self):
+        return self._page_count / self._page_time if self._page_time else 0
+
     @property
     def all_content_stat(self):
         stat_list = [stat.verbose_string for stat in self._content.values()]
         stat_string = ' | '.join([stat for stat in stat_list if stat])
+        extra_string = ''
+        if self._page_count:
+            extra_string += (f' Pages: {self._page_count} '
+                             f'({self.pages_per_second:.1f} / s)')
+        if self._retry_count:
+            extra_string += (f' Retries: {self._retry_count} '
+                             f'({self._retry_delay:.1f} s)')
         if stat_string:
-            return f'[{stat_string}]'
-        return 'user not found or has no content'
+            return f'[{stat_string}]{extra_string}'
+        return f'user not found or has no content{extra_string}'
 
     @property
     def has_error(self):
         return any([stat.error_count for stat in self._content.values()])
 
 
+class VscoContentIndex:
+    """Unique content of a user by media id in insertion order"""
+    def __init__(self):
+        self._content: Dict[str, VscoContent] = {}
+        self._type_counters: Dict[str, int] = {
+            content_type.verbose_content_type: 0
+            for content_type in (VscoPhoto, VscoMiniVideo, VscoVideo)
+        }
+
+    @staticmethod
+    def get_key(content: VscoContent):
+        return content.media_id or content.download_url
+
+    def add(self, content: VscoContent):
+        """:return: False if the content is already in the index"""
+        key = self.get_key(content)
+        if key in self._content:
+            return False
+        self._content[key] = content
+        self._type_counters[content.verbose_content_type] += 1
+        return True
+
+    def count(self, content_type: Type[VscoContent]):
+        return self._type_counters[content_type.verbose_content_type]
+
+    def newest_first(self) -> List[VscoContent]:
+        return self.sort_newest_first(self._content.values())
+
+    @staticmethod
+    def sort_newest_first(
+            content: Iterable[VscoContent]) -> List[VscoContent]:
+        return sorted(content,
+                      key=lambda item:
+                      (-(item.timestamp or 0), str(item.media_id)))
+
+    def __contains__(self, media_id):
+        return media_id in self._content
+
+    def __iter__(self) -> Iterator[VscoContent]:
+        return iter(self._content.values())
+
+    def __len__(self):
+        return len(self._content)
+
+
 class VscoUser:
     reg_exp_username = r'^[A-Za-z0-9_-]*$'
     allowed_vsco_path = ('', 'media', 'gallery', 'video')
@@ -99,15 +173,17 @@ class VscoUser:
         self.scrap_session = session
         self._init_with_short_url = init_with_short_url
         self._user_id = None
-        self._photo_content: Set[VscoPhoto] = set()
-        self._mini_video_content: Set[VscoMiniVideo] = set()
-        self._video_content: Set[VscoVideo] = set()
+        self._content = VscoContentIndex()
         self._current_cursor = None
         self._finisher = False
         self._token = None
         self.download_session = None
+        self.dir_index = None
         self._invalid_account = False
         self._init_content_parsed = False
+        self._processed_count = 0
+        self._known_media_ids: Set[str] = set()
+        self._all_pages_parsed = False
         self._vsco_user_stat = VscoUserStat()
 
     @property
@@ -143,9 +219,12 @@ class VscoUser:
         return self._token
 
     @property
-    def all_content(self):
-        return (self._photo_content | self._mini_video_content
-                | self._video_content)
+    def all_content(self) -> VscoContentIndex:
+        return self._content
+
+    @property
+    def is_all_pages_parsed(self):
+        return self._all_pages_parsed
 
     @property
     def user_url(self):
@@ -154,22 +233,36 @@ class VscoUser:
     def set_username(self, user_name):
         self._user_name = user_name
 
-    def add_content(self, content_dict, force_ignored_content=None):
+    def add_content(self,
+                    content_dict,
+                    force_ignored_content=None) -> Optional[VscoContent]:
+        """:return: new content or None if it is ignored or duplicated"""
         force_ignored_content = force_ignored_content or {}
         content_class = VscoContent.get_content_type(content_dict)
         if content_class.verbose_content_type in force_ignored_content:
-            return
-        content_set = {
-            VscoPhoto: self._photo_content,
-            VscoMiniVideo: self._mini_video_content,
-            VscoVideo: self._video_content
-        }[content_class]
+            return None
+        content = content_class(content_dict)
+        if not self._content.add(content):
+            return None
         self.stat.add_total(content_class)
-        content_set.add(content_class(content_dict))
+        return content
+
+    def set_known_media_ids(self, media_ids: Set[str]):
+        self._known_media_ids = media_ids
+
+    def is_known(self, content: VscoContent):
+        return content.media_id in self._known_media_ids
+
+    def add_processed(self):
+        self._processed_count += 1
+        return self._processed_count
 
     def set_initialized(self):
         self._init_content_parsed = True
 
+    def set_all_pages_parsed(self):
+        self._all_pages_parsed = True
+
     def set_invalid(self):
         self._invalid_account = True
 
@@ -177,12 +270,12 @@ class VscoUser:
         self._init_with_short_url = False
 
     def get_content_link(self, limit=DEFAULT_LIMIT):
+        """Link of the current cursor page or of the first page w/o cursor"""
         assert self._user_id
-        assert self._current_cursor
         return CONTENT_URL.format(user_id=self._user_id,
                                   limit=limit,
                                   cursor=urllib.parse.quote_plus(
-                                      self._current_cursor))
+                                      self._current_cursor or ''))
 
     def set_user_id(self, user_id):
         self._user_id = user_id
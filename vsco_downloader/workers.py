@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from vsco_downloader.argparser import get_init_dict
+from vsco_downloader.container import VscoContent
+from vsco_downloader.downloader import VscoGrabber
+from vsco_downloader.session import ConnectionStat, install_uvloop
+
+
+class UserReport(NamedTuple):
+    name: str
+    stat_string: str
+    has_error: bool
+    is_invalid: bool
+
+
+class WorkerReport(NamedTuple):
+    """Stat of a grabber run, picklable to be sent from a worker"""
+    users: List[UserReport]
+    limits: Dict[str, int]
+    connections_created: int
+    connections_reused: int
+    dedup_stat: Optional[str]
+
+    @classmethod
+    def from_grabber(cls, grabber: VscoGrabber, users):
+        users = [
+            UserReport(str(user), user.stat_string, user.stat.has_error,
+                       user.is_invalid) for user in users
+        ]
+        return cls(users=users,
+                   limits=grabber.limits,
+                   connections_created=grabber.connection_stat.created,
+                   connections_reused=grabber.connection_stat.reused,
+                   dedup_stat=grabber.dedup_stat)
+
+
+def shard(items: Iterable[str], count) -> List[List[str]]:
+    """Split items to ``count`` shards of close sizes, same on every run"""
+    items = sorted(set(items))
+    return [items[index::count] for index in range(count)]
+
+
+def log_reports(reports: List[WorkerReport]):
+    """Log stats of users of all workers (by name) and stats of workers"""
+    stat_logger = logging.getLogger('Stat')
+    users = [user for report in reports for user in report.users]
+    if len(reports) > 1:
+        users.sort(key=lambda user: user.name.lower())
+    for user in users:
+        log = (stat_logger.warning
+               if user.has_error or user.is_invalid else stat_logger.info)
+        log(user.stat_string)
+    connection_stat = ConnectionStat()
+    for index, report in enumerate(reports):
+        logging.info(
+            'Concurrency limits at the end%s: %s', _of_worker(reports, index),
+            ', '.join([
+                f'{host_class} {limit}'
+                for host_class, limit in report.limits.items()
+            ]))
+        connection_stat.created += report.connections_created
+        connection_stat.reused += report.connections_reused
+    logging.info('HTTP %s', connection_stat)
+    for index, report in enumerate(reports):
+        if report.dedup_stat:
+            logging.info('Deduplication%s: %s', _of_worker(reports, index),
+                         report.dedup_stat)
+
+
+def _of_worker(reports, index):
+    return f' of worker {index}' if len(reports) > 1 else ''
+
+
+def _run_shard(loop, args, disabled_content, parse_dict, count, index):
+    # objects of the grabber are bound to the loop of the worker
+    grabber = VscoGrabber(
+        **get_init_dict(args, disabled_content, workers=count, index=index))
+    task = loop.create_task(grabber.parse_users(**parse_dict))
+    try:
+        # like asyncio.run of Python 3.11: Ctrl+C cancels the run,
+        # so users processed so far are reported
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except NotImplementedError:
+        # Windows
+        pass
+    try:
+        users = loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        users = loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        # canceled before downloads of users are started
+        users = []
+    return WorkerReport.from_grabber(grabber, users)
+
+
+def run_worker(args, disabled_content, parse_dict, count, index):
+    """
+    Entry point of a worker process: a shard with its own loop.
+    :return: report of the shard, of processed users if it is interrupted
+    """
+    # the handler of the parent loop is inherited on fork
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    root_logger = logging.getLogger()
+    # handlers of the parent are inherited on fork
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format=f'%(levelname)s:worker {index}:%(name)s:%(message)s')
+    VscoContent.keep_raw = args.debug
+    if args.uvloop:
+        install_uvloop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return _run_shard(loop, args, disabled_content, parse_dict, count,
+                          index)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def run_workers(args, disabled_content, parse_dict):
+    """
+    Download users of ``parse_dict`` by ``args.workers`` processes.
+    Targets are resolved to usernames before sharding, so a user
+    given by a name, an url and a short link is in one shard only.
+    Each worker has its own loop and session with its part of global limits
+    (see ``get_init_dict``).
+    :return: reports of finished workers
+    """
+    resolver = VscoGrabber(**get_init_dict(args, disabled_content))
+    usernames, invalid_users = await resolver.resolve_targets(
+        parse_dict['username_and_urls'], parse_dict['black_list'])
+    invalid_users = [
+        UserReport(str(user), user.stat_string, user.stat.has_error,
+                   user.is_invalid) for user in invalid_users
+    ]
+    shards = [users for users in shard(usernames, args.workers) if users]
+    if not shards:
+        logging.warning('There are no users for download. Stopping...')
+        return [WorkerReport.from_grabber(resolver, invalid_users)]
+    logging.info('%d workers, users per worker: %s', len(shards),
+                 ', '.join(str(len(users)) for users in shards))
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        futures = []
+        for index, users in enumerate(shards):
+            # the black list is applied already
+            shard_dict = {
+                **parse_dict, 'username_and_urls': set(users),
+                'black_list': None
+            }
+            futures.append(
+                loop.run_in_executor(executor, run_worker, args,
+                                     disabled_content, shard_dict,
+                                     len(shards), index))
+        gathering = asyncio.gather(*futures, return_exceptions=True)
+        try:
+            results = await asyncio.shield(gathering)
+        except asyncio.CancelledError:
+            # workers get Ctrl+C too and stop with stats of their users
+            logging.info('Waiting for workers...')
+            results = await gathering
+    reports = []
+    for index, result in enumerate(results):
+        if isinstance(result, BrokenProcessPool):
+            logging.error('Worker %d is terminated', index)
+        elif isinstance(result, BaseException):
+            logging.error('Worker %d failed: %r', index, result)
+        else:
+            reports.append(result)
+    if invalid_users and reports:
+        reports[0] = reports[0]._replace(users=invalid_users +
+                                         reports[0].users)
+    return reports